@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import select
+import subprocess as sp
+import threading
+import time
+import pcm
+
+SAMPLE_RATE = pcm.SAMPLE_RATE
+SAMPLE_WIDTH = 2  # s16le, mono
+BYTES_PER_SECOND = SAMPLE_RATE * SAMPLE_WIDTH
+FRAME_SIZE = BYTES_PER_SECOND // 100  # 10 ms, the smallest opus frame pymumble sends
+# seconds of audio read and processed at once by the scheduler
+BATCH_TIME = 0.04
+
+
+class Decoder(object):
+    """ffmpeg process decoding any source into 48 kHz mono s16le PCM.
+
+    The pipe is non-blocking: read() returns whatever complete frames are
+    available, and fileno() can be given to select() to wait for data.
+    HTTP sources are read with the given headers, and can be saved to tee
+    in their original format while they are decoded. Decoding can start
+    start seconds into the source.
+    """
+
+    def __init__(self, path, debug=False, headers=None, tee=None, start=0):
+        command = ["ffmpeg", '-v', 'debug' if debug else 'warning', '-nostdin']
+        if start:
+            command += ['-ss', '{:.3f}'.format(start)]
+        if path.startswith('http'):
+            command += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+            if headers:
+                command += ['-headers', ''.join('{}: {}\r\n'.format(k, v) for k, v in headers.items())]
+        command += ['-i', path]
+        if tee:
+            # also save the source as is, without re-encoding it
+            command += ['-map', '0:a:0', '-c', 'copy', '-y', tee, '-map', '0:a:0']
+        command += ['-ac', '1', '-f', 's16le', '-ar', str(SAMPLE_RATE), '-']
+        self.path = path
+        self.tee = tee
+        self.start = start  # seconds into the source
+        self.process = sp.Popen(command, stdout=sp.PIPE, bufsize=0)
+        os.set_blocking(self.process.stdout.fileno(), False)
+        self.pending = b''
+        self.eof = False
+        self.position = 0  # bytes of PCM returned so far
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def fill(self, size):
+        # reads what is available from ffmpeg, up to size bytes pending
+        if not self.eof and len(self.pending) < size:
+            try:
+                data = os.read(self.fileno(), size - len(self.pending))
+            except BlockingIOError:
+                data = None
+            except (OSError, ValueError):
+                data = b''
+            if data == b'':
+                self.eof = True
+            elif data:
+                self.pending += data
+
+    def prefill(self, size, timeout=10):
+        # blocks until size bytes are pending (or the end of the stream)
+        deadline = time.monotonic() + timeout
+        while not self.eof and len(self.pending) < size and time.monotonic() < deadline:
+            try:
+                select.select([self], [], [], deadline - time.monotonic())
+            except (OSError, ValueError):
+                break
+            self.fill(size)
+
+    def prepend(self, data):
+        self.pending = data + self.pending
+
+    def read(self, size):
+        # returns at most size bytes, frame aligned except for the very end
+        # of the stream. b'' means no data available for now, check self.eof
+        self.fill(size)
+        if self.eof:
+            length = min(size, len(self.pending))
+        else:
+            length = min(size, len(self.pending)) // FRAME_SIZE * FRAME_SIZE
+        data, self.pending = self.pending[:length], self.pending[length:]
+        self.position += length
+        return data
+
+    def remaining(self):
+        # bytes of PCM read ahead and not played yet
+        return len(self.pending)
+
+    def finished(self):
+        return self.eof and not self.pending
+
+    def succeeded(self):
+        # True once ffmpeg exited normally
+        return self.process.poll() == 0
+
+    def kill(self):
+        if self.eof:
+            # at the end of the stream, give ffmpeg a moment to exit by itself
+            try:
+                self.process.wait(timeout=2)
+            except sp.TimeoutExpired:
+                pass
+        self.eof = True
+        self.pending = b''
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+
+class AudioScheduler(object):
+    """Feed a pymumble connection from a Decoder at the pace it is played.
+
+    The scheduler keeps target_buffer seconds of audio queued in pymumble:
+    it sleeps until the queue drains down to batch seconds below the target
+    (against the monotonic clock), so that audio is read and processed a
+    whole batch at a time, then waits for the decoder to have data, without ever
+    waiting past the moment the queue would run dry. Up to readahead seconds
+    are read from ffmpeg in advance, so the end of a track is known
+    (decoder.eof) that long before it is heard.
+
+    underruns counts the times the queue ran dry while a track was playing,
+    jitter the cumulated lateness of the wake-ups (max_jitter the worst one).
+    """
+
+    def __init__(self, mumble, target_buffer=0.2, readahead=0, batch=BATCH_TIME):
+        self.mumble = mumble
+        self.target_buffer = target_buffer
+        # low-water mark of the queue, at least half of it stays queued
+        self.low_water = target_buffer - min(batch, target_buffer / 2)
+        self.readahead = int(readahead * BYTES_PER_SECOND)
+        self.wakeup = threading.Event()
+        self.underruns = 0
+        self.wakeups = 0
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+        self.bytes_sent = 0
+
+    def wake(self):
+        # interrupt the current wait, e.g. when a track is added or skipped
+        self.wakeup.set()
+
+    def _sleep(self, duration):
+        deadline = time.monotonic() + duration
+        if self.wakeup.wait(duration):
+            self.wakeup.clear()
+            return
+        late = time.monotonic() - deadline
+        if late > 0:
+            self.wakeups += 1
+            self.jitter += late
+            self.max_jitter = max(self.max_jitter, late)
+
+    def idle(self, timeout=0.5):
+        # nothing to play, wait for something to happen
+        self._sleep(timeout)
+
+    def feed(self, decoder, processor):
+        # plays one step of the decoder, returns False once it is finished
+        buffered = self.mumble.sound_output.get_buffer_size()
+        if buffered > self.low_water:
+            self._sleep(buffered - self.low_water)
+            buffered = self.mumble.sound_output.get_buffer_size()
+
+        size = int((self.target_buffer - buffered) * BYTES_PER_SECOND) // FRAME_SIZE * FRAME_SIZE + FRAME_SIZE
+        if not decoder.eof and len(decoder.pending) < size:
+            # wait for the decoder, but not longer than what is still queued
+            timeout = buffered - 0.005 if buffered > 0.005 else 0.1
+            try:
+                readable, _, _ = select.select([decoder], [], [], timeout)
+            except (OSError, ValueError):
+                readable = [decoder]
+            if not readable:
+                return True
+
+        data = decoder.read(size)
+        if data:
+            if buffered == 0 and decoder.position > len(data):
+                self.underruns += 1
+            self.bytes_sent += len(data)
+            self.mumble.sound_output.add_sound(processor.process(data))
+        if self.readahead:
+            decoder.fill(self.readahead)
+
+        return not decoder.finished()
+
+    def feed_frames(self, reader):
+        # same as feed() for a track played from its opus frames
+        # (opuscache.FrameReader), queued in pymumble as they are
+        buffered = self.mumble.sound_output.get_buffer_size()
+        if buffered > self.low_water:
+            self._sleep(buffered - self.low_water)
+            buffered = self.mumble.sound_output.get_buffer_size()
+
+        size = int((self.target_buffer - buffered) * BYTES_PER_SECOND) + FRAME_SIZE
+        queued = reader.queue(self.mumble.sound_output, size)
+        if queued:
+            if buffered == 0 and reader.position > queued:
+                self.underruns += 1
+            self.bytes_sent += queued
+        if self.readahead:
+            reader.fill(self.readahead)
+
+        return not reader.finished()
+
+    def stats(self):
+        return {'underruns': self.underruns,
+                'seconds_played': self.bytes_sent / BYTES_PER_SECOND,
+                'average_jitter': self.jitter / self.wakeups if self.wakeups else 0.0,
+                'max_jitter': self.max_jitter}
+
+    def log_stats(self):
+        logging.debug("Audio scheduler: {underruns} underruns in {seconds_played:.1f}s, "
+                      "jitter avg {average_jitter:.4f}s max {max_jitter:.4f}s".format(**self.stats()))
+
+
+def decode_file(path):
+    # decodes a whole (short) file at once, e.g. a jingle
+    command = ["ffmpeg", '-v', 'warning', '-nostdin', '-i', path, '-ac', '1', '-f', 's16le', '-ar', str(SAMPLE_RATE), '-']
+    return sp.run(command, stdout=sp.PIPE, check=True).stdout
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+import collections
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import media
+
+
+class DownloadCache(object):
+    """Downloaded tracks, kept in their own folder with an LRU index.
+
+    Entries are keyed by the md5 of media.url_key() of the URL, the same
+    for every form of the URL of a video, and record the path, size, last
+    access time and title of the download, so a cache hit doesn't need to
+    read the tags of the file. The index is ordered from least to most
+    recently used: eviction pops from the front, skipping the entries
+    pinned by the player or the prefetcher.
+
+    max_size is in MB; 0 keeps nothing that is not pinned, -1 is unlimited.
+    """
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.index_file = os.path.join(folder, 'cache_index.json')
+        self.lock = threading.RLock()
+        self.save_lock = threading.Lock()  # one write of the index at a time
+        # key -> {'path': str, 'bytes': int, 'access': float, 'title': str, 'thumbnail': str or None}
+        self.entries = collections.OrderedDict()
+        self.pins = collections.Counter()
+        self.total = 0
+
+        os.makedirs(folder, exist_ok=True)
+        self.load()
+
+    @staticmethod
+    def key(url):
+        return hashlib.md5(media.url_key(url).encode()).hexdigest()
+
+    def path(self, key):
+        # download template for youtube-dl
+        return os.path.join(self.folder, key + ".%(ext)s")
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+
+        with self.lock:
+            for key, entry in sorted(entries, key=lambda item: item[1]['access']):
+                if os.path.isfile(entry['path']):
+                    self.entries[key] = entry
+                    self.total += entry['bytes']
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data = list(self.entries.items())
+            tmp_file = self.index_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_file, self.index_file)
+            except OSError as e:
+                logging.error("Unable to write the download cache index: " + str(e))
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.isfile(entry['path']):
+                self._remove(key)
+                return None
+            entry['access'] = time.time()
+            self.entries.move_to_end(key)
+        self.save()
+        return entry
+
+    def acquire(self, key):
+        # lookup() pinning the entry found for the caller
+        self.pin(key)
+        entry = self.lookup(key)
+        if entry is None:
+            self.unpin(key)
+        return entry
+
+    def add(self, key, path, title, thumbnail=None):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key, delete=False)
+            entry = {'path': path, 'bytes': size, 'access': time.time(), 'title': title, 'thumbnail': thumbnail}
+            self.entries[key] = entry
+            self.total += size
+            self.evict()
+        self.save()
+        return entry
+
+    def discard(self, key):
+        # removes the files left by a failed download of key, unless it is cached
+        with self.lock:
+            if key in self.entries:
+                return
+        for path in glob.glob(glob.escape(os.path.join(self.folder, key)) + '.*'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def pin(self, key):
+        with self.lock:
+            self.pins[key] += 1
+
+    def unpin(self, key):
+        with self.lock:
+            self.pins[key] -= 1
+            if self.pins[key] <= 0:
+                del self.pins[key]
+                self.evict()
+
+    def evict(self):
+        if self.max_size < 0:
+            return
+        limit = self.max_size * 1024 * 1024
+        with self.lock:
+            if self.total <= limit:
+                return
+            victims = []
+            total = self.total
+            for key, entry in self.entries.items():
+                if total <= limit:
+                    break
+                if key not in self.pins:
+                    victims.append(key)
+                    total -= entry['bytes']
+            for key in victims:
+                logging.debug("Removing {} from the download cache".format(self.entries[key]['path']))
+                self._remove(key)
+
+    def _remove(self, key, delete=True):
+        entry = self.entries.pop(key)
+        self.total -= entry['bytes']
+        if delete:
+            for path in (entry['path'], entry['path'] + '.loudness', entry['thumbnail']):
+                if path:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import threading
+
+
+class EventBus(object):
+    """State changes of the bot, pushed to the clients of the web interface.
+
+    The bot publishes an event when something changes (the playlist, the
+    current track, the volume...). Each event is serialized once, as a
+    server-sent event, and kept in a short history; the clients of
+    /api/events all wait on the same condition and send the new messages
+    as they are. The last event of each kind is the current state, sent to
+    new clients first.
+    """
+
+    def __init__(self, history=100):
+        self.condition = threading.Condition()
+        self.last_id = 0
+        self.history = collections.deque(maxlen=history)  # (id, message)
+        self.state = {}  # event -> (id, data, message) of its last occurrence
+
+    def publish(self, event, data):
+        data = json.dumps(data)
+        with self.condition:
+            if event in self.state and self.state[event][1] == data:
+                return
+            self.last_id += 1
+            message = "id: {}\nevent: {}\ndata: {}\n\n".format(self.last_id, event, data)
+            self.history.append((self.last_id, message))
+            self.state[event] = (self.last_id, data, message)
+            self.condition.notify_all()
+
+    def get(self, event):
+        # last data published for event, None if there is none
+        with self.condition:
+            if event in self.state:
+                return json.loads(self.state[event][1])
+            return None
+
+    def snapshot(self):
+        # (last id, messages of the current state)
+        with self.condition:
+            messages = [message for _, _, message in sorted(self.state.values())]
+            return self.last_id, messages
+
+    def wait(self, last_id, timeout=None):
+        # (last id, messages published after last_id), blocking until there
+        # are some or the timeout expired. A client too far behind gets the
+        # whole state again
+        with self.condition:
+            self.condition.wait_for(lambda: self.last_id > last_id, timeout)
+            if self.last_id <= last_id:
+                return last_id, []
+            if not self.history or self.history[0][0] > last_id + 1:
+                return self.snapshot()
+            return self.last_id, [message for id, message in self.history if id > last_id]
+
+
+def playlist(bot):
+    return [{'id': item.id, 'index': index, 'type': item.type, 'url': item.url, 'user': item.user,
+             'title': item.title, 'playlist': item.playlist_title}
+            for index, item in enumerate(bot.playlist)]
+
+
+def now_playing(bot):
+    music = bot.current_music
+    if not music:
+        return None
+    data = {'type': music['type'],
+            'title': music.get('title'),
+            'url': music.get('path'),
+            'user': music.get('user')}
+    if music['type'] == "radio":
+        # the station is the title of the music, the title what it plays
+        data['station'] = music.get('title')
+        data['title'] = music.get('radio_title')
+    elif music.get('playlist_title'):
+        data['playlist'] = music['playlist_title']
+    return data
+
+
+def publish_playlist(bot):
+    bot.events.publish('playlist', playlist(bot))
+
+
+def publish_now_playing(bot):
+    bot.events.publish('now_playing', now_playing(bot))
+
+
+def publish_volume(bot):
+    bot.events.publish('volume', int(bot.volume * 100))
@@ -1,14 +1,15 @@
 #!/usr/bin/python3
 
-from flask import Flask, render_template, request, redirect, send_file
+from flask import Flask, render_template, request, redirect, send_file, jsonify, abort, Response, g
 import variables as var
 import util
 from datetime import datetime
 import os.path
-import random
+import time
 from werkzeug.utils import secure_filename
 import errno
-import media
+import events
+import playqueue
 
 
 class ReverseProxied(object):
@@ -51,6 +52,12 @@ class ReverseProxied(object):
 
 web = Flask(__name__)
 
+# entries of the library returned by /api/library at once
+LIBRARY_PAGE_SIZE = 100
+LIBRARY_MAX_PAGE_SIZE = 1000
+# seconds between two messages of /api/events when nothing happens
+EVENTS_KEEPALIVE = 15
+
 
 def init_proxy():
     global web
@@ -58,19 +65,51 @@ def init_proxy():
         web.wsgi_app = ReverseProxied(web.wsgi_app)
 
 
-@web.route("/", methods=['GET', 'POST'])
-def index():
-    folder_path = var.music_folder
-    files = util.get_recursive_filelist_sorted(var.music_folder)
-    music_library = util.Dir(folder_path)
-    for file in files:
-        music_library.add_file(file)
+def route(rule, **options):
+    # the pages are served for the default bot at rule, and for each bot
+    # at /bot/<name>/rule: their relative links stay on the same bot
+    def decorator(f):
+        web.add_url_rule(rule, view_func=f, **options)
+        web.add_url_rule('/bot/<bot>' + rule, view_func=f, **options)
+        return f
+    return decorator
+
+
+@web.url_value_preprocessor
+def pull_bot(endpoint, values):
+    # g.bot is the bot of the page
+    name = values.pop('bot', None) if values else None
+    if name is None:
+        g.bot = next(iter(var.bots.values()), None)
+    else:
+        g.bot = var.bots.get(name)
+    if g.bot is None:
+        abort(404)
+
+
+def get_current_music(bot):
+    # (sourcetype, title, url or None) of the current music, None if nothing is playing
+    music = bot.current_music
+    if not music:
+        return None
+
+    source = music['type']
+    if source == "radio":
+        return ("[radio]", music.get('radio_title'), music['title'])
+    elif source == "url":
+        return ("[url]", music['title'], music['path'])
+    elif source == "file":
+        return ("[file]", music['title'], None)
+    else:
+        return ("(??)[" + music['type'] + "]", music['path'], music['title'])
+
 
+@route("/", methods=['GET', 'POST'])
+def index():
     if request.method == 'POST':
         print(request.form)
         if 'add_file' in request.form and ".." not in request.form['add_file']:
-            item = ('file', request.form['add_file'], 'Web')
-            var.playlist.append(item)
+            g.bot.playlist.append(playqueue.QueueItem('file', request.form['add_file'], 'Web'))
 
         elif ('add_folder' in request.form and ".." not in request.form['add_folder']) or ('add_folder_recursively' in request.form and ".." not in request.form['add_folder_recursively']):
             try:
@@ -82,71 +121,133 @@ def index():
                 folder += '/'
 
             print('folder:', folder)
-            if 'add_folder_recursively' in request.form:
-                files = music_library.get_files_recursively(folder)
+            music_library = var.library.get_tree()
+            node = music_library.find(folder)
+            if node is None:
+                files = []
+            elif 'add_folder_recursively' in request.form:
+                files = music_library.get_files_recursively(node)
             else:
-                files = music_library.get_files(folder)
-            files = list(map(lambda file: ('file', os.path.join(folder, file), 'Web'), files))
+                files = music_library.get_files(node)
+            files = [playqueue.QueueItem('file', file, 'Web') for file in files]
             print('Adding to playlist: ', files)
-            var.playlist.extend(files)
+            g.bot.playlist.extend(files)
 
         elif 'add_url' in request.form:
-            var.playlist.append(['url', request.form['add_url'], "Web"])
+            g.bot.playlist.append(playqueue.QueueItem('url', request.form['add_url'], "Web"))
 
         elif 'add_radio' in request.form:
-            var.playlist.append(['radio', request.form['add_radio'], "Web"])
+            g.bot.playlist.append(playqueue.QueueItem('radio', request.form['add_radio'], "Web"))
 
         elif 'delete_music' in request.form:
-            for item in var.playlist:
-                if str(item[2]) == request.form['delete_music']:
-                    var.playlist.remove(item)
-                    break
+            try:
+                g.bot.playlist.remove(int(request.form['delete_music']))
+            except ValueError:
+                pass
         elif 'action' in request.form:
             action = request.form['action']
             if action == "randomize":
-                random.shuffle(var.playlist)
-
-    if var.current_music:
-        source = var.current_music['type']
-        # format for current_music below:
-        # (sourcetype, title, url or None)
-        if source == "radio":
-            current_music = (
-                "[radio]",
-                media.get_radio_title(var.current_music['path']),
-                var.current_music['title']
-            )
-        elif source == "url":
-            current_music = (
-                "[url]",
-                var.current_music['title'],
-                var.current_music['path']
-            )
-        elif source == "file":
-            current_music = (
-                "[file]",
-                var.current_music['title'],
-                None
-            )
-        else:
-            current_music = (
-                "(??)[" + var.current_music['type'] + "]",
-                var.current_music['path'],
-                var.current_music['title'],
-            )
-    else:
-        current_music = None
+                g.bot.playlist.shuffle()
 
+    # the music library is loaded by the page from /api/library
     return render_template('index.html',
-                           all_files=files,
-                           current_music=current_music,
-                           music_library=music_library,
-                           os=os,
-                           playlist=var.playlist,
-                           user=var.user)
-
-
-@web.route('/upload', methods=["POST"])
+                           current_music=get_current_music(g.bot),
+                           playlist=list(g.bot.playlist),
+                           user=g.bot.username,
+                           bot=g.bot.name,
+                           bots=list(var.bots))
+
+
+@route('/api/library', methods=['GET'])
+def api_library():
+    # one page of the content of a folder of the library: its subfolders
+    # first, then its files
+    path = request.args.get('path', '').strip('/')
+    if '..' in path.split('/'):
+        abort(400)
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', LIBRARY_PAGE_SIZE)), 1), LIBRARY_MAX_PAGE_SIZE)
+    except ValueError:
+        abort(400)
+
+    node = var.library.get_tree().find(path)
+    if node is None:
+        abort(404)
+    subdirs = list(node.subdirs.values())
+
+    items = []
+    for subdir in subdirs[offset:offset + limit]:
+        items.append({'type': 'directory', 'name': subdir.name, 'path': subdir.path.rstrip('/'),
+                      'count': subdir.count, 'size': subdir.size, 'duration': round(subdir.duration)})
+    for name in node.files[max(offset - len(subdirs), 0):max(offset + limit - len(subdirs), 0)]:
+        entry = var.library.get_entry(node.path + name) or {}
+        items.append({'type': 'file', 'name': name, 'path': node.path + name,
+                      'title': entry.get('title'), 'artist': entry.get('artist'),
+                      'duration': entry.get('duration')})
+
+    return jsonify({'path': path,
+                    'offset': offset,
+                    'limit': limit,
+                    'total': len(subdirs) + len(node.files),
+                    'count': node.count,
+                    'size': node.size,
+                    'duration': round(node.duration),
+                    'items': items})
+
+
+@route('/api/playlist', methods=['GET'])
+def api_playlist():
+    return jsonify(events.playlist(g.bot))
+
+
+@route('/api/now_playing', methods=['GET'])
+def api_now_playing():
+    return jsonify(g.bot.events.get('now_playing'))
+
+
+@route('/api/events', methods=['GET'])
+def api_events():
+    # server-sent events: the current state, then its changes as they happen
+    try:
+        last_id = int(request.headers.get('Last-Event-ID'))
+    except (TypeError, ValueError):
+        last_id = None
+
+    duration = var.config.getint('webinterface', 'event_stream_duration')
+    bus = g.bot.events
+
+    def stream(last_id):
+        end = time.monotonic() + duration if duration else None
+        if last_id is None or last_id > bus.last_id:
+            last_id, messages = bus.snapshot()
+            yield 'retry: 3000\n\n' + ''.join(messages)
+        while end is None or time.monotonic() < end:
+            timeout = EVENTS_KEEPALIVE if end is None else max(min(EVENTS_KEEPALIVE, end - time.monotonic()), 0)
+            last_id, messages = bus.wait(last_id, timeout)
+            # a comment when nothing happened, to detect closed connections
+            yield ''.join(messages) if messages else ': keepalive\n\n'
+
+    return Response(stream(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@route('/search', methods=['GET'])
+def search():
+    query = request.args.get('q', '')
+    try:
+        limit = min(int(request.args.get('limit', '')), 100)
+    except ValueError:
+        limit = var.config.getint('bot', 'search_max_results')
+
+    results = []
+    for file in var.search.search(query, limit):
+        entry = var.library.get_entry(file) or {}
+        results.append({'path': file, 'title': entry.get('title'), 'artist': entry.get('artist')})
+    return jsonify(results)
+
+
+@route('/upload', methods=["POST"])
 def upload():
     file = request.files['file']
     if not file:
@@ -183,20 +284,21 @@ def upload():
             return redirect("./", code=406)
 
         file.save(filepath)
+        var.library.update_file(os.path.relpath(filepath, var.music_folder))
+        var.library.flush()
         return redirect("./", code=302)
     else:
         return redirect("./", code=409)
 
 
-@web.route('/download', methods=["GET"])
+@route('/download', methods=["GET"])
 def download():
     if 'file' in request.args:
         requested_file = request.args['file']
         if '../' not in requested_file:
             folder_path = var.music_folder
-            files = util.get_recursive_filelist_sorted(var.music_folder)
 
-            if requested_file in files:
+            if var.library.has_file(requested_file):
                 filepath = os.path.join(folder_path, requested_file)
                 try:
                     return send_file(filepath, as_attachment=True)
@@ -212,12 +314,13 @@ def download():
                 prefix = 'all'
             else:
                 prefix = secure_filename(os.path.relpath(requested_dir_fullpath, folder_path))
-            zipfile = util.zipdir(requested_dir_fullpath, prefix)
-            try:
+            zipfile, stream = util.zipdir(requested_dir_fullpath, prefix)
+            if os.path.isfile(zipfile):
+                stream.close()
                 return send_file(zipfile, as_attachment=True)
-            except Exception as e:
-                self.log.exception(e)
-                self.Error(400)
+            # sent while it is written
+            return Response(stream, mimetype='application/zip',
+                            headers={'Content-Disposition': 'attachment; filename=' + os.path.basename(zipfile)})
 
     return redirect("./", code=400)
 
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import logging
+import os
+import threading
+
+# records appended before the journal is rewritten as one snapshot per bot
+COMPACT_RECORDS = 1000
+
+
+def new_state():
+    return {'queue': collections.OrderedDict(),  # id -> item, see QueueItem.dump()
+            'current': None,  # item being played
+            'position': 0.0,  # seconds played of it
+            'volume': None}
+
+
+def apply(state, record):
+    # updates the state of a bot with one record of the journal
+    op = record['op']
+    queue = state['queue']
+    if op == 'add':
+        added = [(item['id'], item) for item in record['items']]
+        if record.get('index') is None:
+            queue.update(added)
+        else:
+            items = list(queue.items())
+            items[record['index']:record['index']] = added
+            state['queue'] = collections.OrderedDict(items)
+    elif op == 'remove':
+        queue.pop(record['id'], None)
+    elif op == 'move':
+        item = queue.pop(record['id'], None)
+        if item is not None:
+            items = list(queue.items())
+            items.insert(max(record['index'], 0), (record['id'], item))
+            state['queue'] = collections.OrderedDict(items)
+    elif op == 'order':
+        state['queue'] = collections.OrderedDict((id, queue[id]) for id in record['ids'] if id in queue)
+    elif op == 'clear':
+        queue.clear()
+    elif op == 'current':
+        state['current'] = record['item']
+        state['position'] = record.get('position', 0.0)
+    elif op == 'position':
+        state['position'] = record['position']
+    elif op == 'volume':
+        state['volume'] = record['volume']
+    elif op == 'snapshot':
+        state.update(record['state'])
+        state['queue'] = collections.OrderedDict((item['id'], item) for item in record['state']['queue'])
+
+
+class StateJournal(threading.Thread):
+    """What the bots play, recorded as it changes to survive a restart.
+
+    Every change of a queue, the track being played, the position in it and
+    the volume is applied to the state kept in memory, and appended to the
+    journal as one line of JSON by the thread of the journal, so that the
+    bots never wait for the disk. At startup, load() replays the journal
+    (a last line cut by a crash is ignored); it is rewritten as a snapshot
+    of that state every COMPACT_RECORDS records. Position records are
+    flushed to the disk, the others only to the system.
+    """
+
+    def __init__(self, path):
+        threading.Thread.__init__(self, name="StateJournal")
+        self.daemon = True
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.states = collections.defaultdict(new_state)  # bot name -> state
+        self.pending = []  # (line, sync) not written yet
+        self.writing = False
+        self.file = None
+        self.records = 0
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning("Ignoring the end of the state journal, cut at: " + line.strip())
+                        break
+                    apply(self.states[record['bot']], record)
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, TypeError) as e:
+            logging.error("Unable to read the state journal: " + str(e))
+        with self.lock:
+            snapshot = self.snapshot()
+        self.compact(snapshot)
+
+    def get(self, bot):
+        # state of a bot, its queue as a list
+        with self.lock:
+            state = dict(self.states[bot])
+            state['queue'] = list(state['queue'].values())
+            return state
+
+    def append(self, bot, record, sync=False):
+        record['bot'] = bot
+        with self.lock:
+            apply(self.states[bot], record)
+            self.pending.append((json.dumps(record) + '\n', sync))
+            self.records += 1
+            self.changed.notify()
+
+    def close(self):
+        # waits for the records appended so far to be written
+        with self.lock:
+            while self.is_alive() and (self.pending or self.writing):
+                self.changed.wait(1)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.changed.wait()
+                snapshot = None
+                if self.records >= COMPACT_RECORDS:
+                    # the pending records are in the state written instead
+                    snapshot = self.snapshot()
+                    self.records = 0
+                lines, self.pending = self.pending, []
+                self.writing = True
+            if snapshot is not None:
+                self.compact(snapshot)
+            else:
+                self.write(lines)
+            with self.lock:
+                self.writing = False
+                self.changed.notify_all()
+
+    def snapshot(self):
+        # with the lock held: the items are not changed once recorded, the
+        # state is copied as it is and written without the lock
+        return [(bot, dict(state, queue=list(state['queue'].values())))
+                for bot, state in self.states.items()]
+
+    def write(self, lines):
+        if self.file is None:
+            return
+        try:
+            self.file.write(''.join(line for line, sync in lines))
+            self.file.flush()
+            if any(sync for line, sync in lines):
+                os.fsync(self.file.fileno())
+        except OSError as e:
+            logging.error("Unable to write the state journal: " + str(e))
+
+    def compact(self, snapshot):
+        tmp_file = self.path + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                for bot, state in snapshot:
+                    f.write(json.dumps({'bot': bot, 'op': 'snapshot', 'state': state}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logging.error("Unable to write the state journal: " + str(e))
+        if self.file:
+            self.file.close()
+        try:
+            self.file = open(self.path, 'a')
+        except OSError as e:
+            logging.error("Unable to open the state journal: " + str(e))
+            self.file = None
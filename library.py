@@ -0,0 +1,371 @@
+#!/usr/bin/python3
+
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import magic
+import mutagen
+import variables as var
+
+INDEX_VERSION = 3
+
+
+class MusicLibrary(object):
+    """Persistent index of the music folder.
+
+    Every file under the music folder is recorded with its size, mtime and
+    mime type. A rescan only sniffs files whose (size, mtime) changed, so
+    after the first run a rescan costs one stat() per file.
+    """
+
+    def __init__(self, path, index_file):
+        self.path = path
+        self.index_file = index_file
+        self.lock = threading.RLock()
+        # relative path -> {'size': int, 'mtime': float, 'mime': str, 'audio': bool,
+        #                   'title': str, 'artist': str, 'duration': float,  # only for audio files
+        #                   'loudness': float}  # LUFS, once analysed
+        self.entries = {}
+        self.listeners = []
+        self._files = None
+        self._tree = None
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != INDEX_VERSION or data.get('path') != self.path:
+            return False
+
+        with self.lock:
+            self.entries = data['entries']
+            self._invalidate()
+        return True
+
+    def save(self):
+        with self.lock:
+            self.dirty = False
+            data = {'version': INDEX_VERSION, 'path': self.path, 'entries': self.entries}
+            tmp_file = self.index_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_file, self.index_file)
+            except OSError as e:
+                logging.error("Unable to write the library index: " + str(e))
+
+    def add_listener(self, callback):
+        # callback(action, file, entry) is called with the lock held for every
+        # change of a playable file, action being 'add' or 'remove'
+        self.listeners.append(callback)
+
+    def _notify(self, action, file, entry):
+        for callback in self.listeners:
+            callback(action, file, entry)
+
+    def is_ignored(self, file):
+        relroot, filename = os.path.split(file)
+        if relroot != '' and relroot in var.config.get('bot', 'ignored_folders'):
+            return True
+        return filename in var.config.get('bot', 'ignored_files')
+
+    def scan(self, path=''):
+        # index everything under path (relative to the music folder), the
+        # whole library by default
+        sniffed = 0
+        entries = {}
+        top = os.path.join(self.path, path)
+        for root, dirs, files in os.walk(top):
+            relroot = root.replace(self.path, '', 1)
+            if relroot != '' and relroot in var.config.get('bot', 'ignored_folders'):
+                continue
+            if len(relroot):
+                relroot += '/'
+            for file in files:
+                if file in var.config.get('bot', 'ignored_files'):
+                    continue
+
+                file = relroot + file
+                with self.lock:
+                    entry = self.entries.get(file)
+                try:
+                    st = os.stat(os.path.join(self.path, file))
+                except OSError:
+                    continue
+                if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+                    entry = self._sniff(file, st)
+                    sniffed += 1
+                if entry:
+                    entries[file] = entry
+
+        # the index may change meanwhile (uploads, the watcher): what is
+        # removed is computed with the lock held, and only if really gone
+        with self.lock:
+            if path:
+                prefix = path.rstrip('/') + '/'
+                removed = [file for file in self.entries if file.startswith(prefix) and file not in entries]
+            else:
+                removed = [file for file in self.entries if file not in entries]
+            removed = [file for file in removed if not os.path.exists(os.path.join(self.path, file))]
+            for file in removed:
+                self._remove(file)
+            for file, entry in entries.items():
+                if self.entries.get(file) is not entry:
+                    self._add(file, entry)
+        logging.info("Library scanned: {} files, {} sniffed, {} removed".format(len(entries), sniffed, len(removed)))
+        self.flush()
+        return entries
+
+    def update_file(self, file):
+        # (re)index a single file, relative to the music folder
+        if self.is_ignored(file):
+            return False
+        try:
+            st = os.stat(os.path.join(self.path, file))
+        except OSError:
+            return self.remove_file(file)
+
+        entry = self.entries.get(file)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return entry['audio']
+
+        entry = self._sniff(file, st)
+        with self.lock:
+            if entry:
+                self._add(file, entry)
+            else:
+                self._remove(file)
+        return entry is not None and entry['audio']
+
+    def remove_file(self, file):
+        with self.lock:
+            return self._remove(file)
+
+    def remove_folder(self, path):
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for file in [file for file in self.entries if file.startswith(prefix)]:
+                self._remove(file)
+
+    def rename(self, old, new):
+        # move a file or a whole folder without analysing its content again
+        with self.lock:
+            if old in self.entries:
+                moved = {old: new}
+            else:
+                prefix = old.rstrip('/') + '/'
+                moved = {file: new.rstrip('/') + '/' + file[len(prefix):]
+                         for file in self.entries if file.startswith(prefix)}
+            for old_file, new_file in moved.items():
+                entry = self.entries[old_file]
+                self._remove(old_file)
+                if not self.is_ignored(new_file):
+                    self._add(new_file, entry)
+        return len(moved) > 0
+
+    def flush(self):
+        if self.dirty:
+            self.save()
+
+    def _add(self, file, entry):
+        old = self.entries.get(file)
+        self.entries[file] = entry
+        self.dirty = True
+        if old is not None and old['audio']:
+            self._remove_playable(file, old)
+        if entry['audio']:
+            if self._files is not None:
+                bisect.insort(self._files, file)
+            self._tree = None
+            self._notify('add', file, entry)
+
+    def _remove(self, file):
+        entry = self.entries.pop(file, None)
+        if entry is None:
+            return False
+        self.dirty = True
+        if entry['audio']:
+            self._remove_playable(file, entry)
+        return True
+
+    def _remove_playable(self, file, entry):
+        self._notify('remove', file, entry)
+        if self._files is not None:
+            i = bisect.bisect_left(self._files, file)
+            if i < len(self._files) and self._files[i] == file:
+                del self._files[i]
+        self._tree = None
+
+    def _sniff(self, file, st):
+        fullpath = os.path.join(self.path, file)
+        if not os.access(fullpath, os.R_OK):
+            return None
+
+        try:
+            mime = magic.from_file(fullpath, mime=True)
+            audio = 'audio' in mime or 'video' in mime or 'audio' in magic.from_file(fullpath).lower()
+        except (OSError, magic.MagicException):
+            return None
+
+        entry = {'size': st.st_size, 'mtime': st.st_mtime, 'mime': mime, 'audio': audio}
+        if audio:
+            entry.update(self._read_tags(fullpath))
+        return entry
+
+    @staticmethod
+    def _read_tags(fullpath):
+        tags = {'title': None, 'artist': None, 'duration': None}
+        try:
+            audio = mutagen.File(fullpath, easy=True)
+        except (mutagen.MutagenError, OSError):
+            return tags
+        if audio and audio.info:
+            tags['duration'] = getattr(audio.info, 'length', None)
+        if audio and audio.tags:
+            for tag in ('title', 'artist'):
+                if audio.tags.get(tag):
+                    tags[tag] = audio.tags[tag][0]
+        return tags
+
+    def _invalidate(self):
+        self._files = None
+        self._tree = None
+
+    def get_files(self, prefix=''):
+        # sorted list of the playable files, relative to the music folder, a
+        # copy: the library changes its own list as files come and go
+        with self.lock:
+            if self._files is None:
+                self._files = sorted(file for file, entry in self.entries.items() if entry['audio'])
+            files = self._files
+            if not prefix:
+                return list(files)
+            # the files of a folder are contiguous in the sorted list
+            prefix = prefix.rstrip('/')
+            start = bisect.bisect_left(files, prefix + '/')
+            end = bisect.bisect_left(files, prefix + '0', start)  # '0' follows '/'
+            return files[start:end]
+
+    def get_entry(self, file):
+        with self.lock:
+            return self.entries.get(file)
+
+    def set_loudness(self, file, loudness):
+        with self.lock:
+            entry = self.entries.get(file)
+            if entry is not None:
+                entry['loudness'] = loudness
+                self.dirty = True
+
+    def has_file(self, file):
+        with self.lock:
+            entry = self.entries.get(file)
+            return entry is not None and entry['audio']
+
+    def get_tree(self):
+        # LibraryTree of the playable files, built again after a change
+        with self.lock:
+            if self._tree is None:
+                self._tree = LibraryTree(self.get_files(), self.entries)
+            return self._tree
+
+
+class LibraryNode(object):
+    """A folder of a LibraryTree.
+
+    path is relative to the music folder, with a trailing '/' ('' for the
+    root), subdirs maps the names of the subfolders to their node and files
+    are the names of the files directly in the folder, both sorted. All the
+    files under the folder, recursively, are tree.files[start:end]; count,
+    size (bytes) and duration (seconds) are their totals.
+    """
+
+    __slots__ = ('name', 'path', 'subdirs', 'files', 'start', 'end', 'count', 'size', 'duration')
+
+    def __init__(self, name, path, start):
+        self.name = name
+        self.path = path
+        self.subdirs = {}
+        self.files = []
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.size = 0
+        self.duration = 0.0
+
+
+class LibraryTree(object):
+    """Immutable folder tree of the library, with the totals of each folder.
+
+    Built in one pass over the sorted list of files: the files under a
+    folder are contiguous in it, so each node only records its range. A
+    path is found in O(depth) and the files under a folder are a slice,
+    without walking its subfolders. Folder and file names are interned.
+    """
+
+    def __init__(self, files, entries):
+        self.files = tuple(files)
+        self.root = LibraryNode('', '', 0)
+
+        stack = [self.root]  # the folders of the previous file
+        for i, file in enumerate(self.files):
+            parts = file.split('/')
+            depth = len(parts) - 1
+            common = 1
+            while common < len(stack) and common <= depth and stack[common].name == parts[common - 1]:
+                common += 1
+            while len(stack) > common:
+                self._close(stack.pop(), i, stack[-1])
+            for name in parts[len(stack) - 1:depth]:
+                name = sys.intern(name)
+                parent = stack[-1]
+                node = LibraryNode(name, parent.path + name + '/', i)
+                parent.subdirs[name] = node
+                stack.append(node)
+
+            node = stack[-1]
+            node.files.append(sys.intern(parts[-1]))
+            entry = entries.get(file) or {}
+            node.size += entry.get('size', 0)
+            node.duration += entry.get('duration') or 0
+
+        while len(stack) > 1:
+            self._close(stack.pop(), len(self.files), stack[-1])
+        self._close(self.root, len(self.files), None)
+
+    @staticmethod
+    def _close(node, end, parent):
+        # the last file under node was just before end
+        node.end = end
+        node.count = end - node.start
+        node.files = tuple(node.files)
+        node.subdirs = dict(sorted(node.subdirs.items()))
+        if parent is not None:
+            parent.size += node.size
+            parent.duration += node.duration
+
+    def find(self, path):
+        # node of the folder path (relative to the music folder), None if
+        # there is no playable file under it
+        node = self.root
+        for name in path.split('/'):
+            if name and name != '.':
+                node = node.subdirs.get(name)
+                if node is None:
+                    return None
+        return node
+
+    def get_files(self, node):
+        # the files directly in node, relative to the music folder
+        return [node.path + file for file in node.files]
+
+    def get_files_recursively(self, node):
+        # all the files under node, relative to the music folder
+        return self.files[node.start:node.end]
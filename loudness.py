@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import subprocess as sp
+import threading
+
+# priorities of the analysis queue, lower first
+PRIORITY_PLAYBACK = 0
+PRIORITY_LIBRARY = 1
+
+MAX_GAIN_DB = 12
+MIN_GAIN_DB = -24
+
+INTEGRATED_LOUDNESS = re.compile(r'I:\s+(-?[\d.]+|-inf) LUFS')
+
+
+def measure(path):
+    # integrated loudness (EBU R128) of a file in LUFS, None on failure
+    command = ['ffmpeg', '-hide_banner', '-nostats', '-nostdin', '-threads', '1', '-i', path,
+               '-map', 'a:0', '-filter:a', 'ebur128', '-f', 'null', '-']
+    try:
+        result = sp.run(command, stdout=sp.DEVNULL, stderr=sp.PIPE, preexec_fn=lambda: os.nice(10))
+    except OSError as e:
+        logging.error("Loudness analysis of {} failed: {}".format(path, e))
+        return None
+
+    values = INTEGRATED_LOUDNESS.findall(result.stderr.decode(errors='ignore'))
+    if result.returncode != 0 or not values or values[-1] == '-inf':
+        return None
+    return float(values[-1])
+
+
+class LoudnessAnalyzer(threading.Thread):
+    """Measure the loudness of tracks once, in the background.
+
+    Results for files of the music library are stored in its index, others
+    (downloads of the tmp folder) in a small '<file>.loudness' file next to
+    them. get_gain() only reads what is already known: an unknown track
+    plays at its original level and is queued for analysis, tracks about to
+    be played before the rest of the library.
+    """
+
+    def __init__(self, library, target=-18.0):
+        threading.Thread.__init__(self, name="LoudnessAnalyzer")
+        self.daemon = True
+        self.library = library
+        self.target = target
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()  # keeps the queue FIFO per priority
+        self.queued = {}  # path -> priority it is queued with
+        self.analysed = 0
+
+    def analyse_library(self):
+        for file in self.library.get_files():
+            entry = self.library.get_entry(file)
+            if entry and 'loudness' not in entry:
+                self.schedule(os.path.join(self.library.path, file), PRIORITY_LIBRARY)
+
+    def schedule(self, path, priority=PRIORITY_PLAYBACK):
+        if self.queued.get(path, priority + 1) <= priority:
+            return
+        self.queued[path] = priority
+        self.queue.put((priority, next(self.counter), path))
+
+    def _library_file(self, path):
+        # path relative to the music folder for files of the library
+        if path.startswith(self.library.path):
+            file = path[len(self.library.path):].lstrip('/')
+            if self.library.get_entry(file) is not None:
+                return file
+        return None
+
+    def get_loudness(self, path):
+        file = self._library_file(path)
+        if file is not None:
+            entry = self.library.get_entry(file)
+            return entry.get('loudness') if entry else None
+
+        try:
+            with open(path + '.loudness', 'r') as f:
+                data = json.load(f)
+            st = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if data.get('size') != st.st_size or data.get('mtime') != st.st_mtime:
+            return None
+        return data['loudness']
+
+    def get_gain(self, path):
+        # linear gain bringing the track to the target loudness, 1.0 if unknown
+        loudness = self.get_loudness(path)
+        if loudness is None:
+            self.schedule(path)
+            return 1.0
+        gain_db = max(min(self.target - loudness, MAX_GAIN_DB), MIN_GAIN_DB)
+        return 10 ** (gain_db / 20)
+
+    def _store(self, path, loudness):
+        file = self._library_file(path)
+        if file is not None:
+            self.library.set_loudness(file, loudness)
+            return
+
+        try:
+            st = os.stat(path)
+            with open(path + '.loudness', 'w') as f:
+                json.dump({'loudness': loudness, 'size': st.st_size, 'mtime': st.st_mtime}, f)
+        except OSError as e:
+            logging.error("Unable to store the loudness of {}: {}".format(path, e))
+
+    def run(self):
+        while True:
+            priority, _, path = self.queue.get()
+            self.queued.pop(path, None)
+            if not os.path.isfile(path) or self.get_loudness(path) is not None:
+                continue
+
+            loudness = measure(path)
+            if loudness is not None:
+                logging.debug("Loudness of {}: {} LUFS".format(path, loudness))
+                self._store(path, loudness)
+            self.analysed += 1
+            if self.queue.empty() or self.analysed % 50 == 0:
+                self.library.flush()
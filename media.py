@@ -4,10 +4,17 @@ import logging
 import json
 import http.client
 import struct
-import os
+import socket
+import functools
+import urllib.parse
+import youtube_dl
 
+YOUTUBE_VIDEO = re.compile(r'^(?:https?://)?(?:www\.|m\.|music\.)?'
+                           r'(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:.*&)?v=|embed/|v/|shorts/)|youtu\.be/)'
+                           r'([0-9A-Za-z_-]{11})')
 
-def get_radio_server_description(url):
+
+def get_radio_server_description(url, timeout=10):
     p = re.compile('(https?\:\/\/[^\/]*)', re.IGNORECASE)
     res = re.search(p, url)
     base_url = res.group(1)
@@ -16,11 +23,11 @@ def get_radio_server_description(url):
     title_server = None
     try:
         request = urllib.request.Request(url_shoutcast)
-        response = urllib.request.urlopen(request)
+        response = urllib.request.urlopen(request, timeout=timeout)
         data = json.loads(response.read().decode("utf-8"))
         title_server = data['servertitle']
         logging.info("TITLE FOUND SHOUTCAST: " + title_server)
-    except urllib.error.HTTPError:
+    except (urllib.error.URLError, socket.timeout):
         pass
     except http.client.BadStatusLine:
         pass
@@ -30,7 +37,7 @@ def get_radio_server_description(url):
     if not title_server:
         try:
             request = urllib.request.Request(url_icecast)
-            response = urllib.request.urlopen(request)
+            response = urllib.request.urlopen(request, timeout=timeout)
             data = json.loads(response.read().decode('utf-8', errors='ignore'), strict=False)
             source = data['icestats']['source']
             if type(source) is list:
@@ -39,7 +46,7 @@ def get_radio_server_description(url):
             logging.info("TITLE FOUND ICECAST: " + title_server)
             if not title_server:
                 title_server = url
-        except urllib.error.URLError:
+        except (urllib.error.URLError, socket.timeout):
             title_server = url
         except urllib.error.HTTPError:
             return False
@@ -48,25 +55,25 @@ def get_radio_server_description(url):
     return title_server
 
 
-def get_radio_title(url):
+def get_radio_title(url, timeout=10):
     request = urllib.request.Request(url, headers={'Icy-MetaData': 1})
     try:
 
-        response = urllib.request.urlopen(request)
-        icy_metaint_header = int(response.headers['icy-metaint'])
-        if icy_metaint_header is not None:
-            response.read(icy_metaint_header)
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            icy_metaint_header = int(response.headers['icy-metaint'])
+            if icy_metaint_header is not None:
+                response.read(icy_metaint_header)
 
-            metadata_length = struct.unpack('B', response.read(1))[0] * 16  # length byte
-            metadata = response.read(metadata_length).rstrip(b'\0')
-            logging.info(metadata)
-            # extract title from the metadata
-            m = re.search(br"StreamTitle='([^']*)';", metadata)
-            if m:
-                title = m.group(1)
-                if title:
-                    return title.decode()
-    except (urllib.error.URLError, urllib.error.HTTPError):
+                metadata_length = struct.unpack('B', response.read(1))[0] * 16  # length byte
+                metadata = response.read(metadata_length).rstrip(b'\0')
+                logging.info(metadata)
+                # extract title from the metadata
+                m = re.search(br"StreamTitle='([^']*)';", metadata)
+                if m:
+                    title = m.group(1)
+                    if title:
+                        return title.decode()
+    except (urllib.error.URLError, urllib.error.HTTPError, socket.timeout, TypeError):
         pass
     return 'Unable to get the music title'
 
@@ -82,38 +89,21 @@ def get_url(string):
         return False
 
 
-def get_size_folder(path):
-    folder_size = 0
-    for (path, dirs, files) in os.walk(path):
-        for file in files:
-            filename = os.path.join(path, file)
-            folder_size += os.path.getsize(filename)
-    return int(folder_size / (1024 * 1024))
+@functools.lru_cache(maxsize=1024)
+def url_key(url):
+    # stable key of the media behind url, "<extractor>:<id>" when youtube-dl
+    # can tell its id: the different forms of the URL of a video (youtu.be,
+    # watch?v= with other parameters...) have the same key
+    m = YOUTUBE_VIDEO.match(url)
+    if m:
+        return 'youtube:' + m.group(1)
 
+    for ie in youtube_dl.extractor.gen_extractor_classes():
+        if ie.ie_key() != 'Generic' and ie.suitable(url):
+            try:
+                return ie.ie_key().lower() + ':' + ie._match_id(url)
+            except (AssertionError, IndexError):
+                break  # no id in the URL
 
-def clear_tmp_folder(path, size):
-    if size == -1:
-        return
-    elif size == 0:
-        for (path, dirs, files) in os.walk(path):
-            for file in files:
-                filename = os.path.join(path, file)
-                os.remove(filename)
-    else:
-        if get_size_folder(path=path) > size:
-            all_files = ""
-            for (path, dirs, files) in os.walk(path):
-                all_files = [os.path.join(path, file) for file in files]
-                all_files.sort(key=lambda x: os.path.getmtime(x))
-            size_tp = 0
-            print(all_files)
-            for idx, file in enumerate(all_files):
-                size_tp += os.path.getsize(file)
-                if int(size_tp/(1024*1024)) > size:
-                    logging.info("Cleaning tmp folder")
-                    to_remove = all_files[:idx]
-                    print(to_remove)
-                    for f in to_remove:
-                        logging.debug("Removing " + f)
-                        os.remove(os.path.join(path, f))
-                    return
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, parts.query, ''))
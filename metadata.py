@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+
+class MetadataStore(object):
+    """Persistent metadata of the tracks resolved from URLs.
+
+    Entries are keyed by media.url_key() of the URL, so every form of the
+    URL of a video shares them, and hold what youtube-dl told us about it:
+    title, duration, thumbnail URL and webpage URL. They outlive the
+    downloaded file. At most max_entries are kept, the least recently
+    updated ones are dropped first.
+    """
+
+    def __init__(self, index_file, max_entries=10000):
+        self.index_file = index_file
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # one write of the file at a time
+        # key -> {'title': str, 'duration': int, 'thumbnail': str, 'url': str, 'updated': float}
+        self.entries = collections.OrderedDict()
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        with self.lock:
+            self.entries = collections.OrderedDict(sorted(entries.items(), key=lambda item: item[1]['updated']))
+        return True
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                self.dirty = False
+                data = dict(self.entries)
+            tmp_file = self.index_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_file, self.index_file)
+            except OSError as e:
+                logging.error("Unable to write the metadata store: " + str(e))
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def update(self, key, info):
+        # records the fields of a youtube-dl info dict (or of a flat
+        # playlist entry), keeping the known ones it doesn't have
+        with self.lock:
+            entry = self.entries.pop(key, {})
+            for field in ('title', 'duration', 'thumbnail'):
+                if info.get(field):
+                    entry[field] = info[field]
+            if info.get('webpage_url') or info.get('url', '').startswith('http'):
+                entry['url'] = info.get('webpage_url') or info['url']
+            entry['updated'] = time.time()
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+        return entry
@@ -1,99 +1,109 @@
 #!/usr/bin/env python3
 
 import threading
+import collections
+import concurrent.futures
 import time
 import sys
 import signal
 import configparser
-import audioop
 import subprocess as sp
 import argparse
 import os.path
 import pymumble.pymumble_py3 as pymumble
 import interface
 import variables as var
-import hashlib
 import youtube_dl
 import media
 import logging
 import util
+import audio
+import pcm
+import library
+import watcher
+import search
+import loudness
+import prefetch
+import cache
+import events
+import radio
+import streamhub
+import opuscache
+import journal
+import playqueue
+import playlists
+import metadata
 import base64
 from PIL import Image
 from io import BytesIO
+from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
 
 
+# name of the bot configured by the [server] section, served at the root of the web interface
+DEFAULT_INSTANCE = 'default'
+
+
 class MumbleBot:
-    def __init__(self, args):
-        signal.signal(signal.SIGINT, self.ctrl_caught)
-        self.volume = var.config.getfloat('bot', 'volume')
-        self.channel = args.channel
-        var.current_music = {}
-
-        FORMAT = '%(asctime)s: %(message)s'
-        if args.quiet:
-            logging.basicConfig(format=FORMAT, level=logging.ERROR, datefmt='%Y-%m-%d %H:%M:%S')
-        else:
-            logging.basicConfig(format=FORMAT, level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
+    def __init__(self, name, settings):
+        self.name = name
+        self.volume = settings['volume']
+        self.pcm = pcm.PCMProcessor(self.volume)
+        self.channel = settings['channel']
+        self.username = settings['username']
+        self.comment = settings['comment']
+        self.db_section = settings['db_section']  # where the volume is saved
+        self.current_music = {}
 
         ######
-        ## Format of the Playlist :
-        ## [("<type>","<path/url>")]
-        ## types : file, radio, url, is_playlist, number_music_to_play
+        ## The Playlist is a playqueue.PlayQueue of playqueue.QueueItem
+        ## types : file, radio, url (playlists are queued as their url tracks)
         ######
 
         ######
         ## Format of the current_music variable
-        # var.current_music = { "type" : str,
-        #                       "path" : str,                 # path of the file to play
-        #                       "url" : str                   # url to download
-        #                       "title" : str,
-        #                       "user" : str, 
-        #                       "is_playlist": boolean,
-        #                       "number_track_to_play": int,  # FOR PLAYLIST ONLY
-        #                       "start_index" : int,          # FOR PLAYLIST ONLY
-        #                       "current_index" : int}        # FOR PLAYLIST ONLY
-        # len(var.current_music) = 6
-
-        var.playlist = []
-
-        var.user = args.user
-        var.music_folder = var.config.get('bot', 'music_folder')
-        var.is_proxified = var.config.getboolean("webinterface", "is_web_proxified")
+        # self.current_music = { "type" : str,
+        #                        "path" : str,                 # path of the file to play
+        #                        "url" : str                   # url to download
+        #                        "title" : str,
+        #                        "user" : str,
+        #                        "playlist_title" : str}       # tracks queued from a playlist
+
+        self.playlist = playqueue.PlayQueue()
+        self.checkpoint_interval = var.config.getfloat('bot', 'state_position_interval')
+        self.next_checkpoint = 0
+        if var.journal:
+            self.restore_state()
+
         self.exit = False
         self.nb_exit = 0
         self.thread = None
         self.playing = False
-
-        if var.config.getboolean("webinterface", "enabled"):
-            wi_addr = var.config.get("webinterface", "listening_addr")
-            wi_port = var.config.getint("webinterface", "listening_port")
-            interface.init_proxy()
-            tt = threading.Thread(target=start_web_interface, args=(wi_addr, wi_port))
-            tt.daemon = True
-            tt.start()
-
-        if args.host:
-            host = args.host
-        else:
-            host = var.config.get("server", "host")
-        if args.port:
-            port = args.port
-        else:
-            port = var.config.getint("server", "port")
-        if args.password:
-            password = args.password
-        else:
-            password = var.config.get("server", "password")
-
-        if args.user:
-            username = args.user
-        else:
-            username = var.config.get("bot", "username")
-
-        self.mumble = pymumble.Mumble(host, user=username, port=port, password=password,
+        self.switch_lock = threading.RLock()
+        self.prepare_thread = None
+        self.next_track = None  # (current_music it follows, playlist item, music, decoder)
+        self.playing_music = None  # music of the current decoder
+        self.crossfade = var.config.getfloat('bot', 'crossfade')
+        self.playlists = playlists.PlaylistResolver()
+        self.register_commands()
+        self.command_pool = concurrent.futures.ThreadPoolExecutor(max_workers=var.config.getint('bot', 'command_workers'),
+                                                                  thread_name_prefix="Command-" + name)
+        self.command_stats_lock = threading.Lock()
+        self.command_stats = collections.defaultdict(lambda: [0, 0.0, 0.0])  # command -> [count, total, max]
+
+        self.events = events.EventBus()
+        events.publish_volume(self)
+        events.publish_now_playing(self)
+        events.publish_playlist(self)
+        self.playlist.add_listener(self.playlist_changed)
+        var.radio.add_listener(self.radio_updated)
+
+        self.mumble = pymumble.Mumble(settings['host'], user=self.username, port=settings['port'],
+                                      password=settings['password'],
                                       debug=var.config.getboolean('debug', 'mumbleConnection'))
         self.mumble.callbacks.set_callback("text_received", self.message_received)
+        self.scheduler = audio.AudioScheduler(self.mumble, var.config.getfloat('bot', 'audio_buffer'),
+                                              var.config.getfloat('bot', 'preload_time'))
 
         self.mumble.set_codec_profile("audio")
         self.mumble.start()  # start the mumble thread
@@ -104,37 +114,70 @@ class MumbleBot:
             self.mumble.channels.find_by_name(self.channel).move_in()
         self.mumble.set_bandwidth(200000)
 
-        self.loop()
+    def restore_state(self):
+        # the queue and volume recorded in the journal, and the track being
+        # played when the bot stopped, queued first to start where it was
+        state = var.journal.get(self.name)
+        if state['volume'] is not None:
+            self.volume = state['volume']
+            self.pcm.set_volume(self.volume)
+        items = [playqueue.QueueItem.load(item) for item in state['queue']]
+        current = state['current']
+        if current:
+            start = state['position'] if current['type'] != "radio" else 0
+            items.insert(0, playqueue.QueueItem.load(current, start))
+
+        self.playlist.set_recorder(lambda record: var.journal.append(self.name, record))
+        # recorded again, with the ids of this run
+        self.playlist.clear()
+        self.playlist.extend(items)
+        self.record_playing(None)
+        if items:
+            logging.info("{}: {} tracks restored".format(self.name, len(items)))
 
     def ctrl_caught(self, signal, frame):
         logging.info("\nSIGINT caught, quitting")
-        self.exit = True
-        self.stop()
+        self.shutdown()
         if self.nb_exit > 1:
             logging.info("Forced Quit")
             sys.exit(0)
         self.nb_exit += 1
 
+    def register_commands(self):
+        # command name -> (handler, run on the worker pool), built from the
+        # [command] section of the configuration. Handlers are called with
+        # (user, text, parameter) and reply themselves
+        handlers = [
+            ('joinme', self.cmd_joinme, False),
+            ('play_file', self.cmd_play_file, False),
+            ('play_url', self.cmd_play_url, False),
+            ('play_playlist', self.cmd_play_playlist, True),
+            ('play_radio', self.cmd_play_radio, False),
+            ('help', self.cmd_help, False),
+            ('stop', self.cmd_stop, False),
+            ('kill', self.cmd_kill, False),
+            ('update', self.cmd_update, True),
+            ('stop_and_getout', self.cmd_stop_and_getout, False),
+            ('volume', self.cmd_volume, False),
+            ('current_music', self.cmd_current_music, False),
+            ('next', self.cmd_next, True),
+            ('list', self.cmd_list, True),
+            ('queue', self.cmd_queue, False),
+            ('repeat', self.cmd_repeat, False),
+        ]
+        self.commands = {var.config.get('command', key): (handler, slow) for key, handler, slow in handlers}
+        self.joinme_command = var.config.get('command', 'joinme')
+
     def message_received(self, text):
+        # runs on the thread of pymumble: slow commands go to the worker pool
         message = text.message.strip()
+        if not message.startswith('!'):
+            return
+        command, _, parameter = message[1:].partition(' ')
         user = self.mumble.users[text.actor]['name']
-        if message[0] == '!':
-            message = message[1:].split(' ', 1)
-            if len(message) > 0:
-                command = message[0]
-                parameter = ''
-                if len(message) > 1:
-                    parameter = message[1]
-
-            else:
-                return
-
-            logging.info(command + ' - ' + parameter + ' by ' + user)
-
-            if command == var.config.get('command', 'joinme'):
-                self.mumble.users.myself.move_in(self.mumble.users[text.actor]['channel_id'])
-                return
+        logging.info(command + ' - ' + parameter + ' by ' + user)
 
+        if command != self.joinme_command:
             if not self.is_admin(user) and not var.config.getboolean('bot', 'allow_other_channel_message') and self.mumble.users[text.actor]['channel_id'] != self.mumble.users.myself['channel_id']:
                 self.mumble.users[text.actor].send_message(var.config.get('strings', 'not_in_my_channel'))
                 return
@@ -143,171 +186,225 @@ class MumbleBot:
                 self.mumble.users[text.actor].send_message(var.config.get('strings', 'pm_not_allowed'))
                 return
 
-            if command == var.config.get('command', 'play_file') and parameter:
-                music_folder = var.config.get('bot', 'music_folder')
-                # sanitize "../" and so on
-                path = os.path.abspath(os.path.join(music_folder, parameter))
-                if path.startswith(music_folder):
-                    if os.path.isfile(path):
-                        filename = path.replace(music_folder, '')
-                        var.playlist.append(["file", filename, user])
-                    else:
-                        # try to do a partial match
-                        matches = [file for file in util.get_recursive_filelist_sorted(music_folder) if parameter.lower() in file.lower()]
-                        if len(matches) == 0:
-                            self.mumble.users[text.actor].send_message(var.config.get('strings', 'no_file'))
-                        elif len(matches) == 1:
-                            var.playlist.append(["file", matches[0], user])
-                        else:
-                            msg = var.config.get('strings', 'multiple_matches') + '<br />'
-                            msg += '<br />'.join(matches)
-                            self.mumble.users[text.actor].send_message(msg)
-                else:
-                    self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_file'))
-                self.async_download_next()
-
-            elif command == var.config.get('command', 'play_url') and parameter:
-                var.playlist.append(["url", parameter, user])
-                self.async_download_next()
+        if command not in self.commands:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_command'))
+            return
 
-            elif command == var.config.get('command', 'play_playlist') and parameter:
-                offset = 1
-                try:
-                    offset = int(parameter.split(" ")[-1])
-                except ValueError:
-                    pass
-                var.playlist.append(["playlist", parameter, user, var.config.getint('bot', 'max_track_playlist'), offset])
-                self.async_download_next()
+        handler, slow = self.commands[command]
+        if slow:
+            self.command_pool.submit(self.run_command, command, handler, user, text, parameter)
+        else:
+            self.run_command(command, handler, user, text, parameter)
+
+    def run_command(self, command, handler, user, text, parameter):
+        start = time.monotonic()
+        try:
+            handler(user, text, parameter)
+        except Exception as e:
+            logging.exception(e)
+
+        duration = time.monotonic() - start
+        with self.command_stats_lock:
+            stats = self.command_stats[command]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        logging.debug("Command {} handled in {:.1f} ms".format(command, duration * 1000))
+
+    def get_command_stats(self):
+        # command -> {'count', 'average', 'max'} of its handling time in seconds
+        with self.command_stats_lock:
+            return {command: {'count': count, 'average': total / count, 'max': longest}
+                    for command, (count, total, longest) in self.command_stats.items()}
+
+    def cmd_joinme(self, user, text, parameter):
+        self.mumble.users.myself.move_in(self.mumble.users[text.actor]['channel_id'])
+
+    def cmd_play_file(self, user, text, parameter):
+        if not parameter:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_command'))
+            return
+        music_folder = var.config.get('bot', 'music_folder')
+        # sanitize "../" and so on
+        path = os.path.abspath(os.path.join(music_folder, parameter))
+        if path.startswith(music_folder):
+            if os.path.isfile(path):
+                filename = path.replace(music_folder, '')
+                self.playlist.append(playqueue.QueueItem("file", filename, user))
+            else:
+                # try to do a partial match
+                matches = var.search.search(parameter, var.config.getint('bot', 'search_max_results'))
+                if len(matches) == 0:
+                    self.mumble.users[text.actor].send_message(var.config.get('strings', 'no_file'))
+                elif len(matches) == 1:
+                    self.playlist.append(playqueue.QueueItem("file", matches[0], user))
+                else:
+                    msg = var.config.get('strings', 'multiple_matches') + '<br />'
+                    msg += '<br />'.join(matches)
+                    self.mumble.users[text.actor].send_message(msg)
+        else:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_file'))
+        self.async_download_next()
 
-            elif command == var.config.get('command', 'play_radio') and parameter:
-                if var.config.has_option('radio', parameter):
-                    parameter = var.config.get('radio', parameter)
-                var.playlist.append(["radio", parameter, user])
-                self.async_download_next()
+    def cmd_play_url(self, user, text, parameter):
+        if not parameter:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_command'))
+            return
+        # title already known if the video was played before, under any of its URLs
+        known = var.metadata.get(media.url_key(media.get_url(parameter) or parameter))
+        self.playlist.append(playqueue.QueueItem("url", parameter, user, known and known.get('title')))
+        self.async_download_next()
+
+    def cmd_play_playlist(self, user, text, parameter):
+        if not parameter:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_command'))
+            return
+        offset = 1
+        try:
+            offset = int(parameter.split(" ")[-1])
+            parameter = parameter.rsplit(" ", 1)[0]
+        except ValueError:
+            pass
+        url = media.get_url(parameter)
+        # the playlist is read once, its tracks are queued as urls
+        playlist = self.playlists.resolve(url, offset, var.config.getint('bot', 'max_track_playlist')) if url else None
+        if not playlist or not playlist['entries']:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_url'))
+            return
+        for entry in playlist['entries']:
+            var.metadata.update(media.url_key(entry['url']), entry)
+        var.metadata.save()
+        self.playlist.extend(playqueue.QueueItem("url", entry['url'], user, entry['title'], playlist['title'])
+                            for entry in playlist['entries'])
+        self.async_download_next()
+
+    def cmd_play_radio(self, user, text, parameter):
+        if not parameter:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_command'))
+            return
+        if var.config.has_option('radio', parameter):
+            parameter = var.config.get('radio', parameter)
+        self.playlist.append(playqueue.QueueItem("radio", parameter, user))
+        self.async_download_next()
 
-            elif command == var.config.get('command', 'help'):
-                self.send_msg_channel(var.config.get('strings', 'help'))
+    def cmd_help(self, user, text, parameter):
+        self.send_msg_channel(var.config.get('strings', 'help'))
 
-            elif command == var.config.get('command', 'stop'):
-                self.stop()
+    def cmd_stop(self, user, text, parameter):
+        self.stop()
 
-            elif command == var.config.get('command', 'kill'):
-                if self.is_admin(user):
-                    self.stop()
-                    self.exit = True
-                else:
-                    self.mumble.users[text.actor].send_message(var.config.get('strings', 'not_admin'))
-
-            elif command == var.config.get('command', 'update'):
-                if not self.is_admin(user):
-                    self.mumble.users[text.actor].send_message("Starting the update")
-                    tp = sp.check_output([var.config.get('bot', 'pip3_path'), 'install', '--upgrade', 'youtube-dl']).decode()
-                    msg = ""
-                    if "Requirement already up-to-date" in tp:
-                        msg += "Youtube-dl is up-to-date"
-                    else:
-                        msg += "Update done : " + tp.split('Successfully installed')[1]
-                    if 'Your branch is up-to-date' in sp.check_output(['/usr/bin/env', 'git', 'status']).decode():
-                        msg += "<br /> Botamusique is up-to-date"
-                    else:
-                        msg += "<br /> Botamusique have available update"
-                    self.mumble.users[text.actor].send_message(msg)
-                else:
-                    self.mumble.users[text.actor].send_message(var.config.get('strings', 'not_admin'))
-
-            elif command == var.config.get('command', 'stop_and_getout'):
-                self.stop()
-                if self.channel:
-                    self.mumble.channels.find_by_name(self.channel).move_in()
-
-            elif command == var.config.get('command', 'volume'):
-                if parameter is not None and parameter.isdigit() and 0 <= int(parameter) <= 100:
-                    self.volume = float(float(parameter) / 100)
-                    self.send_msg_channel(var.config.get('strings', 'change_volume') % (
-                        int(self.volume * 100), self.mumble.users[text.actor]['name']))
-                    var.db.set('bot', 'volume', str(self.volume))
-                else:
-                    self.send_msg_channel(var.config.get('strings', 'current_volume') % int(self.volume * 100))
-
-            elif command == var.config.get('command', 'current_music'):
-                if var.current_music:
-                    source = var.current_music["type"]
-                    if source == "radio":
-                        reply = "[radio] {title} on {url} by {user}".format(
-                            title=media.get_radio_title(var.current_music["path"]),
-                            url=var.current_music["title"],
-                            user=var.current_music["user"]
-                        )
-                    elif source == "url":
-                        reply = "[url] {title} (<a href=\"{url}\">{url}</a>) by {user}".format(
-                            title=var.current_music["title"],
-                            url=var.current_music["path"],
-                            user=var.current_music["user"]
-                        )
-                    elif source == "file":
-                        reply = "[file] {title} by {user}".format(
-                            title=var.current_music["title"],
-                            user=var.current_music["user"])
-                    elif source == "playlist":
-                        reply = "[playlist] {title} (from the playlist <a href=\"{url}\">{playlist}</a> by {user}".format(
-                            title=var.current_music["title"],
-                            url=var.current_music["path"],
-                            playlist=var.current_music["playlist_title"],
-                            user=var.current_music["user"]
-                        )
-                    else:
-                        reply = "(?)[{}] {} {} by {}".format(
-                            var.current_music["type"],
-                            var.current_music["path"],
-                            var.current_music["title"],
-                            var.current_music["user"]
-                        )
-                else:
-                    reply = var.config.get('strings', 'not_playing')
+    def cmd_kill(self, user, text, parameter):
+        if self.is_admin(user):
+            self.shutdown()
+        else:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'not_admin'))
+
+    def cmd_update(self, user, text, parameter):
+        if self.is_admin(user):
+            self.mumble.users[text.actor].send_message("Starting the update")
+            tp = sp.check_output([var.config.get('bot', 'pip3_path'), 'install', '--upgrade', 'youtube-dl']).decode()
+            msg = ""
+            if "Requirement already up-to-date" in tp:
+                msg += "Youtube-dl is up-to-date"
+            else:
+                msg += "Update done : " + tp.split('Successfully installed')[1]
+            if 'Your branch is up-to-date' in sp.check_output(['/usr/bin/env', 'git', 'status']).decode():
+                msg += "<br /> Botamusique is up-to-date"
+            else:
+                msg += "<br /> Botamusique have available update"
+            self.mumble.users[text.actor].send_message(msg)
+        else:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'not_admin'))
 
-                self.mumble.users[text.actor].send_message(reply)
+    def cmd_stop_and_getout(self, user, text, parameter):
+        self.stop()
+        if self.channel:
+            self.mumble.channels.find_by_name(self.channel).move_in()
 
-            elif command == var.config.get('command', 'next'):
-                if self.get_next():
-                    self.launch_next()
-                    self.async_download_next()
-                else:
-                    self.mumble.users[text.actor].send_message(var.config.get('strings', 'queue_empty'))
-                    self.stop()
+    def cmd_volume(self, user, text, parameter):
+        if parameter is not None and parameter.isdigit() and 0 <= int(parameter) <= 100:
+            self.volume = float(float(parameter) / 100)
+            self.pcm.set_volume(self.volume)
+            self.volume_changed()
+            events.publish_volume(self)
+            self.send_msg_channel(var.config.get('strings', 'change_volume') % (
+                int(self.volume * 100), self.mumble.users[text.actor]['name']))
+            if not var.db.has_section(self.db_section):
+                var.db.add_section(self.db_section)
+            var.db.set(self.db_section, 'volume', str(self.volume))
+            if var.journal:
+                var.journal.append(self.name, {'op': 'volume', 'volume': self.volume})
+        else:
+            self.send_msg_channel(var.config.get('strings', 'current_volume') % int(self.volume * 100))
+
+    def cmd_current_music(self, user, text, parameter):
+        if self.current_music:
+            source = self.current_music["type"]
+            if source == "radio":
+                reply = "[radio] {title} on {url} by {user}".format(
+                    title=self.current_music.get("radio_title") or "(unknown title)",
+                    url=self.current_music["title"],
+                    user=self.current_music["user"]
+                )
+            elif source == "url" and self.current_music.get("playlist_title"):
+                reply = "[playlist] {title} (from the playlist {playlist}) by {user}".format(
+                    title=self.current_music["title"],
+                    playlist=self.current_music["playlist_title"],
+                    user=self.current_music["user"]
+                )
+            elif source == "url":
+                reply = "[url] {title} (<a href=\"{url}\">{url}</a>) by {user}".format(
+                    title=self.current_music["title"],
+                    url=self.current_music["path"],
+                    user=self.current_music["user"]
+                )
+            elif source == "file":
+                reply = "[file] {title} by {user}".format(
+                    title=self.current_music["title"],
+                    user=self.current_music["user"])
+            else:
+                reply = "(?)[{}] {} {} by {}".format(
+                    self.current_music["type"],
+                    self.current_music["path"],
+                    self.current_music["title"],
+                    self.current_music["user"]
+                )
+        else:
+            reply = var.config.get('strings', 'not_playing')
 
-            elif command == var.config.get('command', 'list'):
-                folder_path = var.config.get('bot', 'music_folder')
+        self.mumble.users[text.actor].send_message(reply)
 
-                files = util.get_recursive_filelist_sorted(folder_path)
-                if files:
-                    self.mumble.users[text.actor].send_message('<br>'.join(files))
-                else:
-                    self.mumble.users[text.actor].send_message(var.config.get('strings', 'no_file'))
+    def cmd_next(self, user, text, parameter):
+        if not self.play_next():
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'queue_empty'))
+            self.stop()
 
-            elif command == var.config.get('command', 'queue'):
-                if len(var.playlist) == 0:
-                    msg = var.config.get('strings', 'queue_empty')
-                else:
-                    msg = var.config.get('strings', 'queue_contents') + '<br />'
-                    for (music_type, path, user) in var.playlist:
-                        msg += '({}) {}<br />'.format(music_type, path)
+    def cmd_list(self, user, text, parameter):
+        files = var.library.get_files()
+        if files:
+            self.mumble.users[text.actor].send_message('<br>'.join(files))
+        else:
+            self.mumble.users[text.actor].send_message(var.config.get('strings', 'no_file'))
 
-                self.send_msg_channel(msg)
+    def cmd_queue(self, user, text, parameter):
+        if len(self.playlist) == 0:
+            msg = var.config.get('strings', 'queue_empty')
+        else:
+            msg = var.config.get('strings', 'queue_contents') + '<br />'
+            for item in self.playlist:
+                msg += '({}) {}<br />'.format(item.type, item.title or item.url)
 
-            elif command == var.config.get('command', 'repeat'):
-                var.playlist.append([var.current_music["type"], var.current_music["path"], var.current_music["user"]])
+        self.send_msg_channel(msg)
 
-            else:
-                self.mumble.users[text.actor].send_message(var.config.get('strings', 'bad_command'))
+    def cmd_repeat(self, user, text, parameter):
+        if self.current_music:
+            music = self.current_music
+            self.playlist.append(playqueue.QueueItem(music["type"], music["url"], music["user"],
+                                                    music["title"], music.get("playlist_title")))
 
     def launch_play_file(self, path):
         self.stop()
-        if var.config.getboolean('debug', 'ffmpeg'):
-            ffmpeg_debug = "debug"
-        else:
-            ffmpeg_debug = "warning"
-        command = ["ffmpeg", '-v', ffmpeg_debug, '-nostdin', '-i', path, '-ac', '1', '-f', 's16le', '-ar', '48000', '-']
-        self.thread = sp.Popen(command, stdout=sp.PIPE, bufsize=480)
+        self.thread = audio.Decoder(path, var.config.getboolean('debug', 'ffmpeg'))
         self.playing = True
 
     @staticmethod
@@ -318,214 +415,513 @@ class MumbleBot:
         else:
             return False
 
-    @staticmethod
-    def get_next():
+    def peek_next(self):
+        # Return (music, item) for the track following the current one, without
+        # touching the queue. item is the queue entry the track comes from
+        item = self.playlist.first()
+        if item is None:
+            return None, None
+
+        music = {'type': item.type,
+                 'url': item.url,
+                 'title': item.title,
+                 'user': item.user,
+                 'playlist_title': item.playlist_title,
+                 'start': item.start}
+        return music, item
+
+    def get_next(self):
         # Return True is next is possible
-        if var.current_music and var.current_music['type'] == "playlist":
-            var.current_music['current_index'] += 1
-            if var.current_music['current_index'] <= (var.current_music['start_index'] + var.current_music['number_track_to_play']):
-                return True
+        music, item = self.peek_next()
+        if music is None:
+            return False
+        self.playlist.remove(item.id)
+        self.current_music = music
+        return True
 
-        if not var.playlist:
+    def play_next(self):
+        # Switch to the next track, using the prepared one when still valid.
+        # Return False when there is nothing left to play
+        with self.switch_lock:
+            if self.next_track and self.next_track_valid():
+                self.switch_to_next()
+                return True
+            self.discard_next()
+            if self.get_next():
+                self.launch_next()
+                self.async_download_next()
+                return True
             return False
 
-        if var.playlist[0][0] == "playlist":
-            var.current_music = {'type': var.playlist[0][0],
-                                 'url': var.playlist[0][1],
-                                 'title': None,
-                                 'user': var.playlist[0][2],
-                                 'is_playlist': True,
-                                 'number_track_to_play': var.playlist[0][3],
-                                 'start_index': var.playlist[0][4],
-                                 'current_index': var.playlist[0][4]
-                                 }
+    def prepare_music(self, music):
+        # Resolve music (a current_music dict) into something ffmpeg can play,
+        # filling its path and title. Return None if it can't be played
+        if music["type"] == "url":
+            url = media.get_url(music["url"])
+            if not url:
+                return None
+
+            if var.config.getboolean('bot', 'stream_urls'):
+                entry = var.cache.acquire(var.cache.key(url))
+                if not entry:
+                    return self.prepare_stream(music, url)
+            else:
+                entry = var.prefetcher.get(url)
+            if not entry:
+                return None
+            # pinned in the download cache as long as it is played or about to be
+            music["cache_key"] = var.cache.key(url)
+            path = music["path"] = entry["path"]
+            title = entry["title"]
+            music["thumbnail"] = self.read_thumbnail(entry["thumbnail"])
+
+        elif music["type"] == "file":
+            music["path"] = music["url"]
+            path = var.config.get('bot', 'music_folder') + music["path"]
+            title = music["path"]
+
+        elif music["type"] == "radio":
+            url = media.get_url(music["url"])
+            if not url:
+                return None
+            music["path"] = url
+            path = url
+            # metadata of the radio are fetched by var.radio while it plays
+            var.radio.subscribe(url)
+            music["radio"] = url
+            title = var.radio.get_description(url) or url
+            music["radio_title"] = var.radio.get_title(url)
+
         else:
-            var.current_music = {'type': var.playlist[0][0],
-                                 'url': var.playlist[0][1],
-                                 'title': None,
-                                 'user': var.playlist[0][2]}
-        var.playlist.pop(0)
-        return True
+            return None
+
+        music["title"] = title
+        music["gain"] = 1.0
+        if var.loudness and music["type"] != "radio" and not music.get("stream"):
+            music["gain"] = var.loudness.get_gain(path)
+        return path
+
+    def prepare_stream(self, music, url):
+        # Play url straight from its audio stream instead of downloading it
+        # first. Return the stream URL, None if it can't be resolved
+        info = self.resolve_stream(url)
+        if not info:
+            return None
+
+        key = var.cache.key(url)
+        music["path"] = url
+        music["title"] = info["title"]
+        music["thumbnail"] = None
+        music["stream"] = {'key': key,
+                           'headers': info.get("http_headers"),
+                           'tee': None}
+        if var.config.getboolean('bot', 'stream_cache'):
+            music["stream"]["tee"] = var.cache.path(key).replace("%(ext)s", info.get("ext") or "mka")
+        music["gain"] = 1.0
+        return info["url"]
+
+    @staticmethod
+    def resolve_stream(url):
+        # youtube-dl info of the best audio format of url, without downloading it
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'quiet': True,
+            'noplaylist': True,
+        }
+
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            for i in range(2):
+                try:
+                    info = ydl.extract_info(url, download=False)
+                except youtube_dl.utils.DownloadError:
+                    continue
+                if info.get('_type') == 'playlist':
+                    entries = list(info.get('entries') or [])
+                    info = entries[0] if entries else None
+                if info and info.get('url'):
+                    var.metadata.update(media.url_key(url), info)
+                    var.metadata.save()
+                    return info
+        return None
+
+    def create_decoder(self, path, music):
+        if music["type"] == "radio":
+            # decoded once for all the bots playing it
+            return var.streams.open(path)
+        debug = var.config.getboolean('debug', 'ffmpeg')
+        stream = music.get("stream")
+        start = music.get("start", 0)
+        if stream:
+            if start:
+                # a partial copy is of no use to the download cache
+                stream["tee"] = None
+            return audio.Decoder(path, debug, stream["headers"], stream["tee"], start)
+        if var.frames and not self.crossfade and not var.jingle and not start:
+            # already encoded for mumble if played often, nothing to mix with it
+            reader = var.frames.open(path, self.mumble.sound_output, self.volume * music.get("gain", 1.0))
+            if reader:
+                return reader
+        return audio.Decoder(path, debug, start=start)
+
+    def volume_changed(self):
+        # frames are encoded at the former volume: the track goes on decoded
+        # by ffmpeg, and the next one is prepared again. Done by the worker
+        # pool, switch_lock may be held through a whole download
+        if var.frames is None:
+            return
+        next_track = self.next_track
+        next_decoder = next_track[3] if next_track else None
+        if isinstance(self.thread, opuscache.FrameReader) or isinstance(next_decoder, opuscache.FrameReader):
+            self.command_pool.submit(self.decode_frames)
+
+    def decode_frames(self):
+        with self.switch_lock:
+            decoder = self.thread
+            if isinstance(decoder, opuscache.FrameReader):
+                self.thread = audio.Decoder(decoder.path, var.config.getboolean('debug', 'ffmpeg'),
+                                            start=decoder.position / audio.BYTES_PER_SECOND)
+                decoder.kill()
+                self.scheduler.wake()
+            if self.next_track and isinstance(self.next_track[3], opuscache.FrameReader):
+                self.discard_next()
+
+    def finish(self, decoder, music):
+        # stop decoding music, keeping the copy of a completely streamed track
+        decoder.kill()
+        stream = music.get("stream") if music else None
+        if stream and stream["tee"]:
+            if decoder.succeeded():
+                if var.cache.add(stream["key"], stream["tee"], music["title"]) and var.loudness:
+                    var.loudness.schedule(stream["tee"])
+            else:
+                try:
+                    os.remove(stream["tee"])
+                except OSError:
+                    pass
+            stream["tee"] = None
+        self.release(music)
+
+    def announce(self, music):
+        if music.get("radio"):
+            self.radio_updated(music["radio"])
+        events.publish_now_playing(self)
+        if var.jingle:
+            self.pcm.mix(var.jingle, self.volume)
+        if music["type"] != "url":
+            return
+
+        thumbnail_html = ""
+        if music.get("thumbnail"):
+            thumbnail_html = '<img src="' + music["thumbnail"] + '"/>'
+
+        if var.config.getboolean('bot', 'announce_current_music'):
+            self.send_msg_channel(var.config.get('strings', 'now_playing') % (music["title"], thumbnail_html))
+
+    def radio_updated(self, url):
+        music = self.current_music
+        if music and music.get("radio") == url:
+            music["title"] = var.radio.get_description(url) or url
+            music["radio_title"] = var.radio.get_title(url)
+            events.publish_now_playing(self)
 
     def launch_next(self):
-        path = ""
-        title = ""
-        var.next_downloaded = False
-        logging.debug(var.current_music)
-        if var.current_music["type"] == "url" or var.current_music["type"] == "playlist":
-            url = media.get_url(var.current_music["url"])
+        logging.debug(self.current_music)
+        path = self.prepare_music(self.current_music)
+        if path is None:
+            if self.get_next():
+                self.launch_next()
+                self.async_download_next()
+            return
 
-            if not url:
-                return
+        self.announce(self.current_music)
+        self.set_decoder(self.create_decoder(path, self.current_music), self.current_music)
 
-            media.clear_tmp_folder(var.config.get('bot', 'tmp_folder'), var.config.getint('bot', 'tmp_folder_max_size'))
+    @staticmethod
+    def release(music):
+        # the track won't be played (anymore): its download may be evicted,
+        # its radio no longer polled
+        if music and music.get("cache_key"):
+            var.cache.unpin(music["cache_key"])
+            music["cache_key"] = None
+        if music and music.get("radio"):
+            var.radio.unsubscribe(music["radio"])
+            music["radio"] = None
+
+    def set_decoder(self, decoder, music):
+        if self.thread:
+            self.finish(self.thread, self.playing_music)
+        self.playing_music = music
+        self.pcm.set_track_gain(music.get("gain", 1.0))
+        self.thread = decoder
+        self.scheduler.wake()
+        self.record_playing(music)
+
+    def record_playing(self, music):
+        # what to resume after a restart: the track and where it starts
+        if not var.journal:
+            return
+        item = None
+        if music:
+            item = playqueue.QueueItem(music["type"], music["url"], music["user"],
+                                       music["title"], music.get("playlist_title")).dump()
+        var.journal.append(self.name, {'op': 'current', 'item': item,
+                                       'position': music.get("start", 0) if music else 0})
+        self.next_checkpoint = time.monotonic() + self.checkpoint_interval
+
+    def record_position(self, force=False):
+        if not force and time.monotonic() < self.next_checkpoint:
+            return
+        self.next_checkpoint = time.monotonic() + self.checkpoint_interval
+        decoder, music = self.thread, self.playing_music
+        if decoder and music and music["type"] != "radio":
+            # the decoder may have replaced another one mid-track (volume_changed())
+            position = decoder.start + decoder.position / audio.BYTES_PER_SECOND
+            var.journal.append(self.name, {'op': 'position', 'position': round(position, 2)}, sync=True)
+
+    def async_prepare_next(self):
+        # start decoding the next track while the current one ends
+        if self.prepare_thread is None:
+            self.prepare_thread = threading.Thread(target=self.prepare_next, args=(self.current_music,))
+            self.prepare_thread.daemon = True
+            self.prepare_thread.start()
+
+    def prepare_next(self, current_music):
+        music, item = self.peek_next()
+        if music is None:
+            return
+        logging.info("Preparing next track")
+        path = self.prepare_music(music)
+        if path is None:
+            return
 
-            if var.current_music["type"] == "playlist":
-                path, title = self.download_music(url, var.current_music["current_index"])
-                var.current_music["playlist_title"] = title
+        decoder = self.create_decoder(path, music)
+        decoder.prefill(int(max(self.crossfade, self.scheduler.target_buffer) * audio.BYTES_PER_SECOND))
+        with self.switch_lock:
+            if self.current_music is current_music:
+                self.next_track = (current_music, item, music, decoder)
             else:
-                path, title = self.download_music(url)
-            var.current_music["path"] = path
+                self.finish(decoder, music)
 
-            if os.path.isfile(path):
-                audio = EasyID3(path)
-                if audio["title"]:
-                    title = audio["title"][0]
-
-                path_thumbnail = var.config.get('bot', 'tmp_folder') + hashlib.md5(path.encode()).hexdigest() + '.jpg'
-                thumbnail_html = ""
-                if os.path.isfile(path_thumbnail):
-                    im = Image.open(path_thumbnail)
-                    im.thumbnail((100, 100), Image.ANTIALIAS)
-                    buffer = BytesIO()
-                    im.save(buffer, format="JPEG")
-                    thumbnail_base64 = base64.b64encode(buffer.getvalue())
-                    thumbnail_html = '<img - src="data:image/PNG;base64,' + thumbnail_base64.decode() + '"/>'
-
-                logging.debug(thumbnail_html)
-                if var.config.getboolean('bot', 'announce_current_music'):
-                    self.send_msg_channel(var.config.get('strings', 'now_playing') % (title, thumbnail_html))
-            else:
-                if var.current_music["type"] == "playlist":
-                    var.current_music['current_index'] = var.current_music['number_track_to_play']
-                if self.get_next():
-                    self.launch_next()
-                    self.async_download_next()
-
-        elif var.current_music["type"] == "file":
-            path = var.config.get('bot', 'music_folder') + var.current_music["path"]
-            title = var.current_music["path"]
-
-        elif var.current_music["type"] == "radio":
-            url = media.get_url(var.current_music["path"])
-            if not url:
-                return
-            var.current_music["path"] = url
-            path = url
-            title = media.get_radio_server_description(url)
+    def next_track_valid(self):
+        current_music, item, music, decoder = self.next_track
+        if self.current_music is not current_music:
+            return False
+        return self.playlist.first() is item
+
+    def switch_to_next(self):
+        current_music, item, music, decoder = self.next_track
+        self.next_track = None
+        self.prepare_thread = None
+
+        self.playlist.remove(item.id)
+        if self.crossfade and self.thread and self.thread.eof:
+            tail = self.thread.read(len(self.thread.pending))
+            decoder.prepend(pcm.crossfade(tail, decoder.read(len(tail))))
+
+        logging.debug(music)
+        self.current_music = music
+        self.announce(music)
+        self.set_decoder(decoder, music)
+        self.async_download_next()
+
+    def discard_next(self):
+        if self.next_track:
+            self.finish(self.next_track[3], self.next_track[2])
+        self.next_track = None
+        self.prepare_thread = None
 
-        var.current_music["title"] = title
+    @staticmethod
+    def download_music(url, cancel=None):
+        # Download url into the download cache. Return its cache entry,
+        # pinned for the caller
+        key = var.cache.key(url)
+        var.cache.pin(key)
+        try:
+            entry = var.cache.lookup(key) or MumbleBot.fetch_music(url, key, cancel)
+        except Exception:
+            var.cache.unpin(key)
+            var.cache.discard(key)
+            raise
+        if entry is None:
+            var.cache.unpin(key)
+            var.cache.discard(key)
+        return entry
 
-        if var.config.getboolean('debug', 'ffmpeg'):
-            ffmpeg_debug = "debug"
-        else:
-            ffmpeg_debug = "warning"
+    @staticmethod
+    def fetch_music(url, key, cancel):
+        # download_music() of a track not in the cache yet, None on failure
+        path = var.cache.path(key)
+        mp3 = path.replace(".%(ext)s", ".mp3")
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'outtmpl': path,
+            'noplaylist': True,
+            'writethumbnail': True,
+            'updatetime': False,
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192'},
+                {'key': 'FFmpegMetadata'}]
+        }
+        if cancel:
+            def check_cancelled(status):
+                if cancel.is_set():
+                    raise prefetch.DownloadCancelled()
+            ydl_opts['progress_hooks'] = [check_cancelled]
+
+        logging.info("Downloading " + url)
+        video_title = ""
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            for i in range(2):
+                try:
+                    info_dict = ydl.extract_info(url)
+                    video_title = info_dict['title']
+                    var.metadata.update(media.url_key(url), info_dict)
+                    var.metadata.save()
+                except youtube_dl.utils.DownloadError:
+                    pass
+                else:
+                    break
+
+        if not os.path.isfile(mp3):
+            return None
+
+        try:
+            tags = EasyID3(mp3)
+            if tags.get("title"):
+                video_title = tags["title"][0]
+        except (MutagenError, ValueError):
+            pass  # no tags, the title given by youtube-dl
+        thumbnail = None
+        for ext in ('.jpg', '.webp', '.png'):
+            if os.path.isfile(path.replace(".%(ext)s", ext)):
+                thumbnail = MumbleBot.make_thumbnail(path.replace(".%(ext)s", ext))
+                break
+
+        if var.loudness:
+            var.loudness.schedule(mp3)
+        return var.cache.add(key, mp3, video_title, thumbnail)
+
+    def playlist_changed(self, action, item):
+        events.publish_playlist(self)
+        var.prefetcher.update()
 
-        command = ["ffmpeg", '-v', ffmpeg_debug, '-nostdin', '-i', path, '-ac', '1', '-f', 's16le', '-ar', '48000', '-']
-        self.thread = sp.Popen(command, stdout=sp.PIPE, bufsize=480)
+    @staticmethod
+    def make_thumbnail(image):
+        # Turn the thumbnail written by youtube-dl into the data URI of a
+        # small JPEG, saved next to it in a .thumbnail file. Return its path
+        path = os.path.splitext(image)[0] + '.thumbnail'
+        try:
+            im = Image.open(image)
+            im = im.convert('RGB')
+            im.thumbnail((100, 100), Image.LANCZOS)
+            buffer = BytesIO()
+            im.save(buffer, format="JPEG")
+            with open(path, 'w') as f:
+                f.write('data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode())
+        except OSError as e:
+            logging.error("Unable to make the thumbnail of {}: {}".format(image, e))
+            path = None
+        try:
+            os.remove(image)
+        except OSError:
+            pass
+        return path
 
     @staticmethod
-    def download_music(url, index=None):
-        url_hash = hashlib.md5(url.encode()).hexdigest()
-        if index:
-            url_hash = url_hash + "-" + str(index)
-        path = var.config.get('bot', 'tmp_folder') + url_hash + ".%(ext)s"
-        mp3 = path.replace(".%(ext)s", ".mp3")
-        if os.path.isfile(mp3):
-            audio = EasyID3(mp3)
-            video_title = audio["title"][0]
-        else:
-            if index:
-                ydl_opts = {
-                    'format': 'bestaudio/best',
-                    'outtmpl': path,
-                    'writethumbnail': True,
-                    'updatetime': False,
-                    'playlist_items': str(index),
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192'},
-                        {'key': 'FFmpegMetadata'}]
-                }
-            else:
-                ydl_opts = {
-                    'format': 'bestaudio/best',
-                    'outtmpl': path,
-                    'noplaylist': True,
-                    'writethumbnail': True,
-                    'updatetime': False,
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192'},
-                        {'key': 'FFmpegMetadata'}]
-                }
-            video_title = ""
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                for i in range(2):
-                    try:
-                        info_dict = ydl.extract_info(url)
-                        video_title = info_dict['title']
-                    except youtube_dl.utils.DownloadError:
-                        pass
-                    else:
-                        break
-        return mp3, video_title
+    def read_thumbnail(path):
+        # data URI of a thumbnail made by make_thumbnail()
+        if not path or not path.endswith('.thumbnail'):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
 
     def async_download_next(self):
-        if not var.next_downloaded:
-            var.next_downloaded = True
-            logging.info("Start download in thread")
-            th = threading.Thread(target=self.download_next, args=())
-            th.daemon = True
-            th.start()
-
-    def download_next(self):
-        if not var.current_music:
-            return
-        else:
-            if var.current_music["type"] == "playlist":
-                if var.current_music['current_index'] + 1 <= (var.current_music['start_index'] + var.current_music['number_track_to_play']):
-                    self.download_music(media.get_url(var.current_music['url']), var.current_music["current_index"] + 1)
-
-            if var.playlist:
-                url = media.get_url(var.playlist[0][1])
-                if not url:
-                    return
-                if var.playlist[0][0] == "playlist":
-                    self.download_music(url, var.current_music["current_index"])
-                elif var.playlist[0][0] == "playlist":
-                    self.download_music(url)
+        # something was queued or started playing: wake the audio loop if it
+        # is idle and download what comes next
+        self.scheduler.wake()
+        var.prefetcher.update()
 
     def loop(self):
-        raw_music = ""
         while not self.exit and self.mumble.isAlive():
-
-            while self.mumble.sound_output.get_buffer_size() > 0.5 and not self.exit:
-                time.sleep(0.01)
-            if self.thread:
-                raw_music = self.thread.stdout.read(480)
-                if raw_music:
-                    self.mumble.sound_output.add_sound(audioop.mul(raw_music, 2, self.volume))
+            decoder = self.thread
+            if decoder:
+                if decoder.eof:
+                    # ffmpeg is done, what is left of the track is read ahead
+                    if self.next_track is None:
+                        self.async_prepare_next()
+                    elif decoder.remaining() <= self.crossfade * audio.BYTES_PER_SECOND and self.play_next():
+                        continue
+                if isinstance(decoder, opuscache.FrameReader):
+                    playing = self.scheduler.feed_frames(decoder)
                 else:
-                    time.sleep(0.1)
-            else:
-                time.sleep(0.1)
-
-            if self.thread is None or not raw_music:
-                if self.get_next():
-                    self.launch_next()
-                    self.async_download_next()
-                else:
-                    var.current_music = None
+                    playing = self.scheduler.feed(decoder, self.pcm)
+                if var.journal:
+                    self.record_position()
+                # decoder is replaced when a track is skipped from another thread
+                if playing or decoder is not self.thread:
+                    continue
+                with self.switch_lock:
+                    # unless a track was switched to meanwhile
+                    if decoder is not self.thread:
+                        continue
+                    self.scheduler.log_stats()
+                    self.finish(decoder, self.playing_music)
+                    self.thread = None
+                    self.playing_music = None
+                prepare_thread = self.prepare_thread
+                if prepare_thread:
+                    # rather than preparing the next track a second time
+                    prepare_thread.join()
+
+            if self.exit:
+                # quitting, the queue is kept as it is (shutdown())
+                break
+            if not self.play_next():
+                if self.current_music is not None:
+                    self.current_music = None
+                    self.record_playing(None)
+                    events.publish_now_playing(self)
+                self.scheduler.idle()
 
         while self.mumble.sound_output.get_buffer_size() > 0:
             time.sleep(0.01)
         time.sleep(0.5)
 
-        if self.exit:
-            util.write_db()
+        for command, stats in sorted(self.get_command_stats().items()):
+            logging.debug("{}: command {}: {count} calls, {average:.4f}s average, {max:.4f}s max".format(self.name, command, **stats))
 
     def stop(self):
+        # the downloads of the tracks of the queue are cancelled by the
+        # prefetcher when it is cleared, not the ones of the other bots
+        self.discard_next()
+        if self.thread:
+            self.current_music = None
+            self.finish(self.thread, self.playing_music)
+            self.thread = None
+            self.playing_music = None
+            self.playlist.clear()
+            self.record_playing(None)
+            events.publish_now_playing(self)
+
+    def shutdown(self):
+        # the bot quits: unlike stop(), the queue and the track being played
+        # are kept in the journal, to be resumed where it stopped
+        self.exit = True
+        if var.journal:
+            self.record_position(force=True)
+        self.discard_next()
         if self.thread:
-            var.current_music = None
-            self.thread.kill()
+            self.finish(self.thread, self.playing_music)
             self.thread = None
-            var.playlist = []
+            self.playing_music = None
 
     def set_comment(self):
-        self.mumble.users.myself.comment(var.config.get('bot', 'comment'))
+        self.mumble.users.myself.comment(self.comment)
 
     def send_msg_channel(self, msg, channel=None):
         if not channel:
@@ -533,9 +929,124 @@ class MumbleBot:
         channel.send_text_message(msg)
 
 
+def start_services():
+    # what the bots of the process share: the music library, the download
+    # cache, the metadata of the tracks and radios, and the web interface
+    if var.config.get('bot', 'announce_jingle'):
+        try:
+            var.jingle = audio.decode_file(var.config.get('bot', 'announce_jingle'))
+        except (OSError, sp.CalledProcessError) as e:
+            logging.error("Unable to decode the announce jingle: " + str(e))
+
+    var.music_folder = var.config.get('bot', 'music_folder')
+    var.is_proxified = var.config.getboolean("webinterface", "is_web_proxified")
+
+    var.metadata = metadata.MetadataStore(var.config.get('bot', 'metadata_store'))
+    var.metadata.load()
+    if var.config.get('bot', 'state_journal'):
+        var.journal = journal.StateJournal(var.config.get('bot', 'state_journal'))
+        var.journal.load()
+        var.journal.start()
+
+    var.radio = radio.RadioMetadata(var.config.getint('bot', 'radio_title_interval'))
+    var.radio.start()
+    var.streams = streamhub.StreamHub(var.config.getfloat('bot', 'radio_buffer'),
+                                      var.config.getboolean('debug', 'ffmpeg'))
+
+    var.library = library.MusicLibrary(var.music_folder, var.config.get('bot', 'library_index'))
+    var.library.load()
+    var.library.scan()
+    var.search = search.SearchIndex(var.library)
+    if var.config.getboolean('bot', 'normalize_loudness'):
+        var.loudness = loudness.LoudnessAnalyzer(var.library, var.config.getfloat('bot', 'loudness_target'))
+        var.loudness.start()
+        if var.config.getboolean('bot', 'analyse_library_loudness'):
+            var.loudness.analyse_library()
+    if var.config.getboolean('bot', 'library_watch'):
+        library_watcher = watcher.LibraryWatcher(var.library, var.config.getint('bot', 'library_poll_interval'))
+        library_watcher.start()
+
+    cache_folder = var.config.get('bot', 'download_cache_folder') or os.path.join(var.config.get('bot', 'tmp_folder'), 'botamusique_cache')
+    var.cache = cache.DownloadCache(cache_folder, var.config.getint('bot', 'tmp_folder_max_size'))
+    if var.config.getint('bot', 'frames_cache_size'):
+        if opuscache.opuslib:
+            var.frames = opuscache.FrameCache(os.path.join(cache_folder, 'frames'), var.config.getint('bot', 'frames_cache_size'),
+                                              var.config.getint('bot', 'frames_cache_min_plays'))
+            var.frames.start()
+        else:
+            logging.error("opuslib is not installed, the frames cache is disabled")
+    # streamed tracks are not downloaded ahead
+    prefetch_count = 0 if var.config.getboolean('bot', 'stream_urls') else var.config.getint('bot', 'prefetch_count')
+    var.prefetcher = prefetch.Prefetcher(MumbleBot.download_music, var.config.getint('bot', 'prefetch_workers'), prefetch_count)
+
+    if var.config.getboolean("webinterface", "enabled"):
+        wi_addr = var.config.get("webinterface", "listening_addr")
+        wi_port = var.config.getint("webinterface", "listening_port")
+        interface.init_proxy()
+        tt = threading.Thread(target=start_web_interface, args=(wi_addr, wi_port))
+        tt.daemon = True
+        tt.start()
+
+
+def get_instances(args):
+    # name -> settings of the bots to run: the default one, configured by
+    # the [server] and [bot] sections and the command line, then the ones
+    # listed by the instances option, each one by an [instance:name]
+    # section overriding the settings of the default bot
+    default = {'host': args.host or var.config.get("server", "host"),
+               'port': args.port or var.config.getint("server", "port"),
+               'password': args.password or var.config.get("server", "password"),
+               'channel': args.channel or var.config.get("server", "channel"),
+               'username': args.user or var.config.get("bot", "username"),
+               'comment': var.config.get('bot', 'comment'),
+               'volume': var.config.getfloat('bot', 'volume'),
+               'db_section': 'bot'}
+    instances = collections.OrderedDict([(DEFAULT_INSTANCE, default)])
+
+    for name in var.config.get('bot', 'instances').split(';'):
+        name = name.strip()
+        section = 'instance:' + name
+        if not name:
+            continue
+        if name in instances or not var.config.has_section(section):
+            logging.error("Instance {} ignored: duplicated, or no [{}] section".format(name, section))
+            continue
+        settings = dict(default, db_section=section)
+        for key in ('host', 'password', 'channel', 'comment'):
+            settings[key] = var.config.get(section, key, fallback=default[key])
+        # two users of a server can't have the same name
+        settings['username'] = var.config.get(section, 'username', fallback=default['username'] + '-' + name)
+        settings['port'] = var.config.getint(section, 'port', fallback=default['port'])
+        settings['volume'] = var.config.getfloat(section, 'volume', fallback=default['volume'])
+        instances[name] = settings
+    return instances
+
+
+def ctrl_caught(signal, frame):
+    for bot in list(var.bots.values()):
+        bot.ctrl_caught(signal, frame)
+
+
 def start_web_interface(addr, port):
     print('Starting web interface on {}:{}'.format(addr, port))
-    interface.web.run(port=port, host=addr)
+    max_upload_size = var.config.getint('webinterface', 'max_upload_size') * 1024 * 1024
+    interface.web.config['MAX_CONTENT_LENGTH'] = max_upload_size
+    if var.config.get('webinterface', 'server') == 'waitress':
+        try:
+            import waitress
+        except ImportError:
+            logging.error("waitress is not installed, using the builtin web server")
+        else:
+            # request bodies over 1 MB are buffered in a temporary file
+            waitress.serve(interface.web, host=addr, port=port,
+                           threads=var.config.getint('webinterface', 'threads'),
+                           connection_limit=var.config.getint('webinterface', 'connection_limit'),
+                           channel_timeout=var.config.getint('webinterface', 'channel_timeout'),
+                           max_request_body_size=max_upload_size,
+                           inbuf_overflow=1024 * 1024,
+                           ident='botamusique')
+            return
+    interface.web.run(port=port, host=addr, threaded=True)
 
 
 if __name__ == '__main__':
@@ -568,4 +1079,31 @@ if __name__ == '__main__':
 
     var.config = config
     var.db = db
-    botamusique = MumbleBot(args)
+
+    FORMAT = '%(asctime)s: %(message)s'
+    if args.quiet:
+        logging.basicConfig(format=FORMAT, level=logging.ERROR, datefmt='%Y-%m-%d %H:%M:%S')
+    else:
+        logging.basicConfig(format=FORMAT, level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
+
+    signal.signal(signal.SIGINT, ctrl_caught)
+    start_services()
+    for name, settings in get_instances(args).items():
+        var.bots[name] = MumbleBot(name, settings)
+    # downloads the tracks restored from the journal
+    var.prefetcher.update()
+
+    # each bot plays in its own thread, until it is killed or disconnected
+    threads = []
+    for name, bot in var.bots.items():
+        thread = threading.Thread(target=bot.loop, name="Bot-" + name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if any(bot.exit for bot in var.bots.values()):
+        util.write_db()
+    if var.journal:
+        var.journal.close()
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+
+import collections
+import hashlib
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import subprocess as sp
+import threading
+import time
+import audio
+import pcm
+
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+# frames file: MAGIC, then the header (frame size in samples, number of
+# frames), then each frame prefixed by its length
+MAGIC = b'BOPF'
+HEADER = struct.Struct('<HI')
+LENGTH = struct.Struct('<H')
+# plays counted at most, the least played are forgotten first
+MAX_PLAY_COUNTS = 10000
+
+
+def encoder_params(sound_output):
+    # (opus profile, bitrate, frame size in samples) used by pymumble, None
+    # if it doesn't encode with opus (yet)
+    encoder = sound_output.encoder
+    if isinstance(encoder, PassthroughEncoder):
+        encoder = encoder.encoder
+    if encoder is None or opuslib is None or not isinstance(encoder, opuslib.Encoder):
+        return None
+    return (getattr(sound_output, 'opus_profile', 'audio'), encoder.bitrate,
+            int(sound_output.encoder_framesize * audio.SAMPLE_RATE))
+
+
+class EncodedFrame(bytes):
+    """Silence of the length of a frame, queued in pymumble in place of the
+    PCM of an already encoded frame: PassthroughEncoder sends `opus` as is."""
+
+
+class PassthroughEncoder(object):
+    # wraps the opus encoder of pymumble
+    def __init__(self, encoder):
+        object.__setattr__(self, 'encoder', encoder)
+
+    def encode(self, pcm, frame_size):
+        if isinstance(pcm, EncodedFrame):
+            return pcm.opus
+        return self.encoder.encode(pcm, frame_size)
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.encoder, name, value)
+
+
+class FrameReader(object):
+    """A track played from its frames file, used in place of an audio.Decoder.
+
+    The file is memory-mapped and its frames queued in pymumble as they are
+    (see AudioScheduler.feed_frames()); position and remaining() count
+    the PCM the frames stand for.
+    """
+
+    def __init__(self, source, file):
+        self.path = source
+        self.file = file
+        self.lock = threading.Lock()
+        with open(file, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.mm.close()
+            raise ValueError("not a frames file: " + file)
+        self.frame_samples, self.count = HEADER.unpack_from(self.mm, len(MAGIC))
+        self.frame_bytes = self.frame_samples * audio.SAMPLE_WIDTH
+        self.offset = len(MAGIC) + HEADER.size
+        self.index = 0
+        self.eof = False
+        self.start = 0  # seconds into the track, always from its beginning
+        self.position = 0  # bytes of PCM queued so far
+
+    def queue(self, sound_output, size):
+        # queues about size bytes worth of frames, returns the PCM size they stand for
+        if not isinstance(sound_output.encoder, PassthroughEncoder):
+            sound_output.encoder = PassthroughEncoder(sound_output.encoder)
+        silence = bytes(self.frame_bytes)
+        frames = []
+        with self.lock:
+            if self.mm.closed:
+                return 0
+            while self.index < self.count and len(frames) * self.frame_bytes < size:
+                length, = LENGTH.unpack_from(self.mm, self.offset)
+                frame = EncodedFrame(silence)
+                frame.opus = self.mm[self.offset + LENGTH.size:self.offset + LENGTH.size + length]
+                frames.append(frame)
+                self.offset += LENGTH.size + length
+                self.index += 1
+        with sound_output.lock:
+            sound_output.pcm.extend(frames)
+        self.position += len(frames) * self.frame_bytes
+        return len(frames) * self.frame_bytes
+
+    def fill(self, size):
+        # the frames are all there: the end is known once the rest fits in size
+        if self.remaining() <= size:
+            self.eof = True
+
+    def remaining(self):
+        return (self.count - self.index) * self.frame_bytes
+
+    def finished(self):
+        return self.index >= self.count
+
+    def succeeded(self):
+        return True
+
+    def kill(self):
+        self.eof = True
+        with self.lock:
+            self.mm.close()
+
+
+class FrameCache(threading.Thread):
+    """Opus frames of the tracks played often, encoded once for pymumble.
+
+    Frames depend on the track and on what pymumble encodes with: opus
+    profile, bitrate, frame size, and the gain (volume times loudness
+    correction) applied before. A track is encoded in the background, once
+    it was played min_plays times with the same settings; the least
+    recently played are removed above max_size MB.
+    """
+
+    def __init__(self, folder, max_size, min_plays=3):
+        threading.Thread.__init__(self, name="FrameCache")
+        self.daemon = True
+        self.folder = folder
+        self.max_size = max_size
+        self.min_plays = min_plays
+        self.index_file = os.path.join(folder, 'frames_index.json')
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # one write of the index at a time
+        # key -> {'bytes': int, 'access': float}
+        self.entries = collections.OrderedDict()
+        self.plays = collections.Counter()  # key -> times played
+        self.total = 0
+        self.queue = queue.Queue()
+        self.queued = set()
+
+        os.makedirs(folder, exist_ok=True)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            for key, entry in sorted(data['entries'].items(), key=lambda item: item[1]['access']):
+                if os.path.isfile(self.path(key)):
+                    self.entries[key] = entry
+                    self.total += entry['bytes']
+            self.plays.update(data['plays'])
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data = {'entries': dict(self.entries), 'plays': dict(self.plays)}
+            tmp_file = self.index_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_file, self.index_file)
+            except OSError as e:
+                logging.error("Unable to write the frames cache index: " + str(e))
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.frames')
+
+    @staticmethod
+    def key(source, params, gain):
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        return hashlib.md5(json.dumps([source, stat.st_mtime, stat.st_size, params, round(gain, 3)]).encode()).hexdigest()
+
+    def open(self, source, sound_output, gain):
+        # FrameReader of source if it is encoded, else None. Counts the play,
+        # and encodes the track when played often enough
+        params = encoder_params(sound_output)
+        key = self.key(source, params, gain) if params else None
+        if key is None:
+            return None
+
+        with self.lock:
+            self.plays[key] += 1
+            if len(self.plays) > MAX_PLAY_COUNTS:
+                self.plays = collections.Counter(dict(self.plays.most_common(MAX_PLAY_COUNTS // 2)))
+            entry = self.entries.get(key)
+            if entry:
+                entry['access'] = time.time()
+                self.entries.move_to_end(key)
+            elif self.plays[key] >= self.min_plays and key not in self.queued:
+                self.queued.add(key)
+                self.queue.put((key, source, params, gain))
+        self.save()
+
+        if entry:
+            try:
+                return FrameReader(source, self.path(key))
+            except (OSError, ValueError) as e:
+                logging.error("Unable to read the frames of {}: {}".format(source, e))
+                with self.lock:
+                    self._remove(key)
+        return None
+
+    def run(self):
+        while True:
+            key, source, params, gain = self.queue.get()
+            try:
+                size = self.encode(source, self.path(key), params, gain)
+            except Exception as e:
+                logging.exception(e)
+                size = None
+            with self.lock:
+                self.queued.discard(key)
+                if size:
+                    self.entries[key] = {'bytes': size, 'access': time.time()}
+                    self.total += size
+                    self.evict()
+            self.save()
+
+    @staticmethod
+    def encode(source, path, params, gain):
+        # writes the frames of source to path, returns their size (None on failure)
+        profile, bitrate, frame_samples = params
+        logging.info("Encoding the frames of " + source)
+        encoder = opuslib.Encoder(audio.SAMPLE_RATE, 1, profile)
+        encoder.bitrate = bitrate
+        processor = pcm.PCMProcessor(gain)
+        frame_bytes = frame_samples * audio.SAMPLE_WIDTH
+        command = ['ffmpeg', '-v', 'warning', '-nostdin', '-i', source,
+                   '-ac', '1', '-f', 's16le', '-ar', str(audio.SAMPLE_RATE), '-']
+        tmp_path = path + '.tmp'
+        count = 0
+        with sp.Popen(command, stdout=sp.PIPE, preexec_fn=lambda: os.nice(10)) as process, open(tmp_path, 'wb') as f:
+            f.write(MAGIC + HEADER.pack(frame_samples, 0))
+            while True:
+                data = process.stdout.read(frame_bytes)
+                if not data:
+                    break
+                frame = encoder.encode(processor.process(data.ljust(frame_bytes, b'\0')), frame_samples)
+                f.write(LENGTH.pack(len(frame)) + frame)
+                count += 1
+            f.seek(len(MAGIC))
+            f.write(HEADER.pack(frame_samples, count))
+        if process.returncode != 0 or not count:
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    def evict(self):
+        limit = self.max_size * 1024 * 1024
+        while self.total > limit and self.entries:
+            key = next(iter(self.entries))
+            logging.debug("Removing the frames {} from the frames cache".format(key))
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total -= entry['bytes']
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+import array
+import math
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SAMPLE_RATE = 48000
+MAX_SAMPLE = 32767
+CLIP_THRESHOLD = int(MAX_SAMPLE * 0.9)
+
+
+def soft_clip_sample(x):
+    # leaves samples under CLIP_THRESHOLD untouched and bends the rest
+    # smoothly towards MAX_SAMPLE instead of clipping them
+    if -CLIP_THRESHOLD <= x <= CLIP_THRESHOLD:
+        return int(x)
+    knee = MAX_SAMPLE - CLIP_THRESHOLD
+    y = CLIP_THRESHOLD + knee * math.tanh((abs(x) - CLIP_THRESHOLD) / knee)
+    return int(y) if x > 0 else -int(y)
+
+
+class PCMProcessor(object):
+    """Gain, mixing and clipping stage for 48 kHz mono s16le PCM.
+
+    Works on whole chunks, with NumPy when available and with the array
+    module otherwise. The applied gain is the volume times the loudness
+    correction of the track; its changes are ramped over ramp_time seconds
+    to avoid zipper noise, and a second source (an announcement for example)
+    can be mixed on top of the music with mix(). Samples that would clip
+    are soft clipped.
+    """
+
+    def __init__(self, volume=1.0, ramp_time=0.05):
+        self.volume = volume
+        self.track_gain = 1.0
+        self.target = volume
+        self.gain = volume
+        self.step = 0.0
+        self.ramp_left = 0
+        self.ramp_samples = max(int(ramp_time * SAMPLE_RATE), 1)
+        self.lock = threading.Lock()
+        self.overlay = None
+        self.overlay_gain = 1.0
+
+    def set_volume(self, volume):
+        with self.lock:
+            self.volume = volume
+            self._ramp_to(self.volume * self.track_gain)
+
+    def set_track_gain(self, gain):
+        # loudness correction of the current track, on top of the volume
+        with self.lock:
+            self.track_gain = gain
+            self._ramp_to(self.volume * self.track_gain)
+
+    def _ramp_to(self, target):
+        self.target = target
+        self.ramp_left = self.ramp_samples
+        self.step = (target - self.gain) / self.ramp_samples
+
+    def mix(self, pcm, gain=1.0):
+        # plays pcm on top of the next processed chunks
+        with self.lock:
+            if numpy:
+                self.overlay = numpy.frombuffer(pcm, dtype=numpy.int16).astype(numpy.float32) * gain
+            else:
+                self.overlay = array.array('h', pcm)
+                self.overlay_gain = gain
+
+    def process(self, pcm):
+        with self.lock:
+            if numpy:
+                return self._process_numpy(pcm)
+            return self._process_array(pcm)
+
+    def _next_gains(self, count):
+        # returns (gain at the start of the ramp, number of ramping samples)
+        start = self.gain
+        ramp = min(count, self.ramp_left)
+        self.ramp_left -= ramp
+        if self.ramp_left:
+            self.gain += self.step * ramp
+        else:
+            self.gain = self.target
+        return start, ramp
+
+    def _process_numpy(self, pcm):
+        samples = numpy.frombuffer(pcm, dtype=numpy.int16).astype(numpy.float32)
+        start, ramp = self._next_gains(len(samples))
+        if ramp:
+            samples[:ramp] *= start + self.step * numpy.arange(1, ramp + 1, dtype=numpy.float32)
+            samples[ramp:] *= self.gain
+        else:
+            samples *= self.gain
+
+        may_clip = self.gain > 1.0 or start > 1.0
+        if self.overlay is not None:
+            length = min(len(samples), len(self.overlay))
+            samples[:length] += self.overlay[:length]
+            self.overlay = self.overlay[length:] if length < len(self.overlay) else None
+            may_clip = True
+
+        if may_clip:
+            loud = numpy.abs(samples) > CLIP_THRESHOLD
+            if loud.any():
+                knee = MAX_SAMPLE - CLIP_THRESHOLD
+                clipped = CLIP_THRESHOLD + knee * numpy.tanh((numpy.abs(samples[loud]) - CLIP_THRESHOLD) / knee)
+                samples[loud] = numpy.copysign(clipped, samples[loud])
+
+        return samples.astype(numpy.int16).tobytes()
+
+    def _process_array(self, pcm):
+        samples = array.array('h', pcm)
+        start, ramp = self._next_gains(len(samples))
+        gain = self.gain
+        step = self.step
+
+        if self.overlay is not None:
+            overlay = self.overlay
+            length = min(len(samples), len(overlay))
+            og = self.overlay_gain
+            out = [s * (start + step * (i + 1) if i < ramp else gain) + (overlay[i] * og if i < length else 0)
+                   for i, s in enumerate(samples)]
+            self.overlay = overlay[length:] if length < len(overlay) else None
+            return array.array('h', map(soft_clip_sample, out)).tobytes()
+
+        if ramp:
+            out = [s * (start + step * (i + 1)) for i, s in enumerate(samples[:ramp])]
+            out += [s * gain for s in samples[ramp:]]
+        else:
+            out = [s * gain for s in samples]
+
+        if gain > 1.0 or start > 1.0:
+            return array.array('h', map(soft_clip_sample, out)).tobytes()
+        return array.array('h', map(int, out)).tobytes()
+
+
+def crossfade(tail, head):
+    # mixes the end of a track with the beginning of the next one, fading
+    # linearly from the first to the second over the length of tail
+    head = head[:len(tail)].ljust(len(tail), b'\0')
+    if numpy:
+        a = numpy.frombuffer(tail, dtype=numpy.int16).astype(numpy.float32)
+        b = numpy.frombuffer(head, dtype=numpy.int16).astype(numpy.float32)
+        fade = numpy.linspace(0.0, 1.0, len(a), endpoint=False, dtype=numpy.float32)
+        return (a * (1 - fade) + b * fade).astype(numpy.int16).tobytes()
+
+    a = array.array('h', tail)
+    b = array.array('h', head)
+    length = len(a)
+    return array.array('h', [int(x + (y - x) * i / length) for i, (x, y) in enumerate(zip(a, b))]).tobytes()
+
+
+if __name__ == '__main__':
+    # microbenchmark: cost of one second of audio through the former
+    # audioop.mul on 480 byte chunks, and through PCMProcessor on the chunks
+    # the scheduler reads while a track plays (a batch and one frame)
+    import timeit
+    import audio
+
+    second = array.array('h', (int(10000 * math.sin(i / 10)) for i in range(SAMPLE_RATE))).tobytes()
+    rounds = 20
+    print("numpy: {}".format("yes" if numpy else "no (array fallback)"))
+
+    try:
+        import warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            import audioop
+    except ImportError:
+        audioop = None
+
+    if audioop:
+        chunks = [second[i:i + 480] for i in range(0, len(second), 480)]
+        t = timeit.timeit(lambda: [audioop.mul(chunk, 2, 0.1) for chunk in chunks], number=rounds) / rounds
+        print("audioop.mul, 480 B chunks:      {:8.3f} ms per second of audio".format(t * 1000))
+
+    chunk_size = int(audio.BATCH_TIME * audio.BYTES_PER_SECOND) + audio.FRAME_SIZE
+    processor = PCMProcessor(0.1)
+    chunks = [second[i:i + chunk_size] for i in range(0, len(second), chunk_size)]
+    t = timeit.timeit(lambda: [processor.process(chunk) for chunk in chunks], number=rounds) / rounds
+    print("PCMProcessor, {:5d} B chunks:    {:8.3f} ms per second of audio".format(chunk_size, t * 1000))
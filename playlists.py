@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+import itertools
+import logging
+import threading
+import time
+import youtube_dl
+
+
+def track_url(entry):
+    # webpage URL of an entry of a flat playlist extraction
+    url = entry.get('webpage_url') or entry.get('url') or entry.get('id')
+    if url and not url.startswith('http') and entry.get('ie_key') == 'Youtube':
+        url = 'https://www.youtube.com/watch?v=' + url
+    return url
+
+
+class PlaylistResolver(object):
+    """Resolve playlist URLs into their list of tracks, once.
+
+    The playlist page is extracted flat (without resolving each video), and
+    its entries are read lazily: only the pages up to the last wanted
+    track are fetched. Results are kept `ttl` seconds, keyed by the URL and
+    the range of tracks.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.resolved = {}  # (url, start, count) -> (time, playlist)
+
+    def extract(self, url, start=1, count=20):
+        # {'title': str, 'entries': [{'id', 'title', 'duration', 'url'}]}
+        # for the tracks start to start + count (1-based), None on failure
+        ydl_opts = {
+            'extract_flat': 'in_playlist',
+            'quiet': True,
+        }
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            try:
+                info = ydl.extract_info(url, download=False, process=False)
+                if info.get('_type') == 'url':
+                    # e.g. a redirection to the playlist page
+                    info = ydl.extract_info(info['url'], ie_key=info.get('ie_key'), download=False, process=False)
+            except youtube_dl.utils.DownloadError as e:
+                logging.error("Unable to read the playlist {}: {}".format(url, e))
+                return None
+
+            if info.get('_type') not in ('playlist', 'multi_video'):
+                return None
+            entries = []
+            first = max(start - 1, 0)
+            for entry in itertools.islice(info.get('entries') or [], first, first + count):
+                track = track_url(entry)
+                if track:
+                    entries.append({'id': entry.get('id'),
+                                    'title': entry.get('title'),
+                                    'duration': entry.get('duration'),
+                                    'url': track})
+        return {'title': info.get('title') or url, 'entries': entries}
+
+    def resolve(self, url, start=1, count=20):
+        key = (url, start, count)
+        now = time.monotonic()
+        with self.lock:
+            cached = self.resolved.get(key)
+            if cached and now - cached[0] < self.ttl:
+                return cached[1]
+
+        playlist = self.extract(url, start, count)
+        if playlist:
+            with self.lock:
+                self.resolved = {k: v for k, v in self.resolved.items() if now - v[0] < self.ttl}
+                self.resolved[key] = (now, playlist)
+        return playlist
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+import collections
+import itertools
+import random
+import threading
+
+
+class QueueItem(object):
+    """An entry of the play queue.
+
+    type is one of file, url and radio, url the path of the file (relative
+    to the music folder) or the URL. The title is known beforehand for the
+    tracks of a playlist, queued with the title of their playlist. A track
+    interrupted by a restart is queued again to start where it stopped.
+    """
+
+    __slots__ = ('id', 'type', 'url', 'user', 'title', 'playlist_title', 'start')
+
+    def __init__(self, type, url, user, title=None, playlist_title=None, start=0):
+        self.id = None  # set when queued
+        self.type = type
+        self.url = url
+        self.user = user
+        self.title = title
+        self.playlist_title = playlist_title
+        self.start = start  # seconds
+
+    def __repr__(self):
+        return "QueueItem({}, {}, {}, {})".format(self.id, self.type, self.url, self.user)
+
+    def dump(self):
+        return {'id': self.id, 'type': self.type, 'url': self.url, 'user': self.user,
+                'title': self.title, 'playlist': self.playlist_title}
+
+    @classmethod
+    def load(cls, data, start=0):
+        return cls(data['type'], data['url'], data['user'], data.get('title'), data.get('playlist'), start)
+
+
+class PlayQueue(object):
+    """The queue of the tracks to play, shared by the bot and the web interface.
+
+    Items are kept in insertion order in an OrderedDict keyed by their
+    unique id, so taking the first one and removing any of them by id are
+    O(1); inserting or moving elsewhere than at the ends is O(n). All the
+    operations hold the lock. Listeners are called, outside of the lock,
+    with the action ('add', 'remove', 'move', 'shuffle', 'clear') and the
+    item concerned (None when several are). The recorder is called with the
+    lock held, in the order of the changes, with a record of each one (see
+    journal.apply()).
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = collections.OrderedDict()
+        self.ids = itertools.count(1)
+        self.listeners = []
+        self.recorder = None
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def set_recorder(self, callback):
+        self.recorder = callback
+
+    def _record(self, op, **record):
+        if self.recorder:
+            record['op'] = op
+            self.recorder(record)
+
+    def _notify(self, action, item=None):
+        for callback in self.listeners:
+            callback(action, item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def __iter__(self):
+        # iterates over a snapshot, the queue may change meanwhile
+        with self.lock:
+            return iter(list(self.items.values()))
+
+    def get(self, id):
+        return self.items.get(id)
+
+    def first(self):
+        with self.lock:
+            return next(iter(self.items.values()), None)
+
+    def append(self, item):
+        with self.lock:
+            item.id = next(self.ids)
+            self.items[item.id] = item
+            self._record('add', items=[item.dump()])
+        self._notify('add', item)
+        return item
+
+    def extend(self, items):
+        items = list(items)
+        with self.lock:
+            for item in items:
+                item.id = next(self.ids)
+                self.items[item.id] = item
+            self._record('add', items=[item.dump() for item in items])
+        self._notify('add')
+
+    def insert(self, index, item):
+        with self.lock:
+            item.id = next(self.ids)
+            self.items[item.id] = item
+            self._move(item.id, index)
+            self._record('add', items=[item.dump()], index=max(index, 0))
+        self._notify('add', item)
+        return item
+
+    def move(self, id, index):
+        with self.lock:
+            item = self.items.get(id)
+            if item is None:
+                return False
+            self._move(id, index)
+            self._record('move', id=id, index=index)
+        self._notify('move', item)
+        return True
+
+    def _move(self, id, index):
+        if index <= 0:
+            self.items.move_to_end(id, last=False)
+        elif index >= len(self.items) - 1:
+            self.items.move_to_end(id)
+        else:
+            # move the items that follow index after it
+            following = [key for key in self.items if key != id][index:]
+            self.items.move_to_end(id)
+            for key in following:
+                self.items.move_to_end(key)
+
+    def remove(self, id):
+        with self.lock:
+            item = self.items.pop(id, None)
+            if item is not None:
+                self._record('remove', id=id)
+        if item is not None:
+            self._notify('remove', item)
+        return item
+
+    def popleft(self):
+        with self.lock:
+            if not self.items:
+                return None
+            _, item = self.items.popitem(last=False)
+            self._record('remove', id=item.id)
+        self._notify('remove', item)
+        return item
+
+    def shuffle(self):
+        with self.lock:
+            items = list(self.items.items())
+            random.shuffle(items)
+            self.items = collections.OrderedDict(items)
+            self._record('order', ids=list(self.items))
+        self._notify('shuffle')
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self._record('clear')
+        self._notify('clear')
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+import concurrent.futures
+import logging
+import threading
+import media
+import variables as var
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class Prefetcher(object):
+    """Download the upcoming URL tracks ahead of time.
+
+    update() looks at the next `lookahead` tracks of the queue of every bot
+    and downloads them with at most `workers` downloads at a time, once
+    for all the bots. Downloads of tracks no longer coming up (removed from
+    the queues, or skipped) are cancelled.
+    """
+
+    def __init__(self, download, workers=2, lookahead=3):
+        # download(url, cancel) returns the cache entry of the track, pinned
+        # for the caller, or None
+        self.download = download
+        self.lookahead = lookahead
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Prefetch")
+        self.lock = threading.Lock()
+        # media.url_key(url) -> (future, cancel event, url). Finished jobs are
+        # kept, with their cache entry pinned, until the track is played or
+        # dropped
+        self.jobs = {}
+
+    def upcoming(self):
+        # the urls of the next URL tracks of each bot
+        tracks = []
+        for bot in list(var.bots.values()):
+            queued = []
+            for item in bot.playlist:
+                if len(queued) >= self.lookahead:
+                    break
+                if item.type == "url":
+                    queued.append(media.get_url(item.url))
+                elif item.type == "file":
+                    queued.append(None)  # occupies a slot of the lookahead
+            tracks.extend(queued)
+
+        return [track for track in tracks if track]
+
+    def update(self):
+        wanted = {media.url_key(url): url for url in self.upcoming()}
+        with self.lock:
+            for key in list(self.jobs):
+                if key not in wanted:
+                    self._drop(key)
+
+            for key, url in wanted.items():
+                if key not in self.jobs:
+                    cancel = threading.Event()
+                    future = self.executor.submit(self._download, url, cancel)
+                    self.jobs[key] = (future, cancel, url)
+
+    def _drop(self, key):
+        future, cancel, url = self.jobs.pop(key)
+        if future.done():
+            if not future.cancelled() and future.result():
+                var.cache.unpin(var.cache.key(url))
+        elif not future.cancel():
+            logging.info("Cancelling download of {}".format(url))
+            cancel.set()
+
+    def _download(self, url, cancel):
+        try:
+            entry = self.download(url, cancel)
+        except DownloadCancelled:
+            return None
+        except Exception as e:
+            logging.exception(e)
+            return None
+        if entry and cancel.is_set():
+            # dropped while finishing
+            var.cache.unpin(var.cache.key(url))
+            return None
+        return entry
+
+    def get(self, url):
+        # return the cache entry of a track, pinned for the caller: the one of
+        # its prefetch (waiting for it if needed), or downloads it now. The job
+        # stays in jobs until it is done, so that update() doesn't start a
+        # second download of the same track meanwhile
+        key = media.url_key(url)
+        with self.lock:
+            job = self.jobs.get(key)
+        if job:
+            try:
+                entry = job[0].result()
+            except concurrent.futures.CancelledError:
+                entry = None
+            with self.lock:
+                # unless update() dropped it (and its pin) while we waited
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
+                    if entry:
+                        return entry
+        return self.download(url, None)
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+import logging
+import threading
+import time
+import media
+
+
+class RadioMetadata(threading.Thread):
+    """Titles of the radios being played, fetched in the background.
+
+    A radio is polled while at least one track uses it (subscribe() /
+    unsubscribe()): its server description once, the title it plays (ICY
+    metadata) every `interval` seconds at most, whatever the number of
+    readers. get_title() and get_description() only read what was last
+    fetched, and listeners are called with the URL of a radio whose
+    metadata changed.
+    """
+
+    def __init__(self, interval=30, timeout=10):
+        threading.Thread.__init__(self, name="RadioMetadata")
+        self.daemon = True
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # url -> {'refs': int, 'title': str, 'description': str, 'next_poll': float}
+        self.stations = {}
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def subscribe(self, url):
+        with self.lock:
+            station = self.stations.get(url)
+            if station is None:
+                self.stations[url] = {'refs': 1, 'title': None, 'description': None, 'next_poll': 0}
+                self.wakeup.set()
+            else:
+                station['refs'] += 1
+
+    def unsubscribe(self, url):
+        with self.lock:
+            station = self.stations.get(url)
+            if station:
+                station['refs'] -= 1
+                if station['refs'] <= 0:
+                    del self.stations[url]
+
+    def get_title(self, url):
+        station = self.stations.get(url)
+        return station['title'] if station else None
+
+    def get_description(self, url):
+        station = self.stations.get(url)
+        return station['description'] if station else None
+
+    def poll(self, url, station):
+        changed = False
+        if station['description'] is None:
+            description = media.get_radio_server_description(url, self.timeout) or url
+            station['description'] = description
+            changed = True
+
+        title = media.get_radio_title(url, self.timeout)
+        if title != station['title']:
+            station['title'] = title
+            changed = True
+
+        if changed:
+            logging.debug("Radio {}: {}".format(url, title))
+            for callback in self.listeners:
+                try:
+                    callback(url)
+                except Exception as e:
+                    logging.exception(e)
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                due = [(url, station) for url, station in self.stations.items() if station['next_poll'] <= now]
+            for url, station in due:
+                station['next_poll'] = now + self.interval
+                try:
+                    self.poll(url, station)
+                except Exception as e:
+                    logging.exception(e)
+
+            with self.lock:
+                next_poll = min((station['next_poll'] for station in self.stations.values()), default=None)
+            timeout = None if next_poll is None else max(next_poll - time.monotonic(), 0)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
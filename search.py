@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import heapq
+import itertools
+import os
+import threading
+
+# files matching a query scored at most, found from its rarest trigram
+MAX_CANDIDATES = 200
+
+
+def normalize(text):
+    return ' '.join(text.lower().replace('_', ' ').split())
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex(object):
+    """In-memory trigram index over the playable files of a MusicLibrary.
+
+    Files are matched on their path and on their title/artist tags. Every
+    word of the query has to appear in a file for it to match, and at least
+    one word has to be 3 characters long. Candidates are taken from the
+    posting list of the rarest trigram of the query, checked against the
+    other ones, and the search stops after MAX_CANDIDATES matches: a query
+    matching more files ranks those, plus the files titled exactly as the
+    query. The candidates are scored outside the lock.
+    """
+
+    def __init__(self, library):
+        self.lock = threading.Lock()
+        self.docs = {}      # doc id -> (file, text, name)
+        self.ids = {}       # file -> doc id
+        self.postings = {}  # trigram -> set of doc ids
+        self.names = {}     # name -> set of doc ids
+        self.next_id = 0
+
+        with library.lock:
+            for file, entry in library.entries.items():
+                if entry['audio']:
+                    self._add(file, entry)
+            library.add_listener(self.on_library_change)
+
+    def on_library_change(self, action, file, entry):
+        with self.lock:
+            if action == 'add':
+                self._add(file, entry)
+            else:
+                self._remove(file)
+
+    def _add(self, file, entry):
+        if file in self.ids:
+            self._remove(file)
+
+        name = normalize(entry.get('title') or os.path.splitext(os.path.basename(file))[0])
+        text = normalize(' '.join([file, entry.get('artist') or '', entry.get('title') or '']))
+        doc_id = self.next_id
+        self.next_id += 1
+        self.docs[doc_id] = (file, text, name)
+        self.ids[file] = doc_id
+        self.names.setdefault(name, set()).add(doc_id)
+        for trigram in trigrams(text):
+            self.postings.setdefault(trigram, set()).add(doc_id)
+
+    def _remove(self, file):
+        doc_id = self.ids.pop(file, None)
+        if doc_id is None:
+            return
+        file, text, name = self.docs.pop(doc_id)
+        same_name = self.names.get(name)
+        if same_name is not None:
+            same_name.discard(doc_id)
+            if not same_name:
+                del self.names[name]
+        for trigram in trigrams(text):
+            posting = self.postings.get(trigram)
+            if posting is not None:
+                posting.discard(doc_id)
+                if not posting:
+                    del self.postings[trigram]
+
+    def search(self, query, limit=20):
+        # returns the best matching files, best first
+        query = normalize(query)
+        words = query.split()
+        query_trigrams = set()
+        for word in words:
+            query_trigrams |= trigrams(word)
+        if not query_trigrams:
+            # no word long enough to be looked up
+            return []
+
+        with self.lock:
+            postings = []
+            for trigram in query_trigrams:
+                posting = self.postings.get(trigram)
+                if not posting:
+                    return []
+                postings.append(posting)
+            postings.sort(key=len)
+            rarest, others = postings[0], postings[1:]
+            matches = (doc_id for doc_id in rarest
+                       if all(doc_id in posting for posting in others)
+                       and all(word in self.docs[doc_id][1] for word in words))
+            candidates = set(itertools.islice(matches, MAX_CANDIDATES))
+            candidates.update(self.names.get(query, ()))
+            # the documents are tuples, never changed once added
+            docs = [self.docs[doc_id] for doc_id in candidates]
+
+        results = [(self._score(query, words, text, name), file) for file, text, name in docs]
+        return [file for score, file in heapq.nsmallest(limit, results)]
+
+    @staticmethod
+    def _score(query, words, text, name):
+        # lower is better
+        score = 0
+        if name == query:
+            score -= 100
+        elif query in name:
+            score -= 50
+        elif query in text:
+            score -= 20
+        for word in words:
+            if word in name:
+                score -= 5
+            if (' ' + word) in (' ' + text) or ('/' + word) in text:
+                score -= 2
+        return score, len(text)
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import select
+import threading
+import time
+import audio
+
+# bytes read from ffmpeg at once by the thread of a shared stream (100 ms)
+CHUNK_SIZE = audio.FRAME_SIZE * 10
+
+
+class SharedStream(object):
+    """One ffmpeg decoding a stream for all the bots playing it.
+
+    A thread reads the PCM as ffmpeg produces it into a ring buffer of
+    `capacity` bytes, and wakes up the readers. The ring is never waited
+    for: a reader more than capacity bytes behind skips what was
+    overwritten.
+    """
+
+    def __init__(self, url, capacity, debug=False):
+        self.url = url
+        self.capacity = capacity // audio.FRAME_SIZE * audio.FRAME_SIZE
+        self.buffer = bytearray(self.capacity)
+        self.written = 0  # bytes written since the start of the stream
+        self.lock = threading.Lock()
+        self.readers = set()
+        self.ended = False
+        self.stopped = False
+        self.decoder = audio.Decoder(url, debug)
+        self.thread = threading.Thread(target=self.run, name="SharedStream")
+        self.thread.daemon = True
+
+    def run(self):
+        while not self.stopped and not self.decoder.finished():
+            try:
+                select.select([self.decoder], [], [], 1)
+            except (OSError, ValueError):
+                break
+            data = self.decoder.read(CHUNK_SIZE)
+            if data:
+                self.write(data)
+        self.decoder.kill()
+        with self.lock:
+            self.ended = True
+            self.notify()
+
+    def notify(self):
+        # with the lock held: a reader is removed before its pipe is closed
+        for reader in self.readers:
+            reader.notify()
+
+    def write(self, data):
+        with self.lock:
+            start = self.written % self.capacity
+            end = start + len(data)
+            if end <= self.capacity:
+                self.buffer[start:end] = data
+            else:
+                split = self.capacity - start
+                self.buffer[start:] = data[:split]
+                self.buffer[:end - self.capacity] = data[split:]
+            self.written += len(data)
+            self.notify()
+
+    def read(self, cursor, size):
+        # (data, cursor after it, bytes skipped) of at most size bytes from
+        # cursor, or from the oldest byte still in the ring
+        with self.lock:
+            oldest = max(self.written - self.capacity, 0)
+            skipped = 0
+            if cursor < oldest:
+                skipped = oldest - cursor
+                cursor = oldest
+            length = min(size, self.written - cursor)
+            if length <= 0:
+                return b'', cursor, skipped
+            start = cursor % self.capacity
+            end = start + length
+            if end <= self.capacity:
+                data = bytes(self.buffer[start:end])
+            else:
+                data = bytes(self.buffer[start:]) + bytes(self.buffer[:end - self.capacity])
+            return data, cursor + length, skipped
+
+    def stop(self):
+        # ffmpeg is killed by the thread, within a second
+        self.stopped = True
+
+
+class StreamReader(object):
+    """A bot playing a shared stream, used in place of its audio.Decoder.
+
+    It starts at the live edge of the stream and reads from the ring at
+    its own pace. fileno() is the end of a pipe written to when new data
+    is available, so it can be given to select() as well.
+    """
+
+    def __init__(self, hub, stream):
+        self.hub = hub
+        self.stream = stream
+        self.path = stream.url
+        self.tee = None
+        self.cursor = 0  # position in the stream, set by StreamHub.open()
+        self.skipped = 0
+        self.pending = b''
+        self.eof = False
+        self.position = 0  # bytes of PCM returned so far
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+
+    def fileno(self):
+        return self.wakeup_read
+
+    def notify(self):
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except (BlockingIOError, OSError):
+            pass  # already readable, or closed
+
+    def fill(self, size):
+        # reads what the stream has, up to size bytes pending
+        if self.eof or len(self.pending) >= size:
+            return
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        ended = self.stream.ended
+        data, self.cursor, skipped = self.stream.read(self.cursor, size - len(self.pending))
+        if skipped:
+            self.skipped += skipped
+        self.pending += data
+        if ended and not data:
+            self.eof = True
+
+    def prefill(self, size, timeout=10):
+        # blocks until size bytes are pending (or the end of the stream)
+        deadline = time.monotonic() + timeout
+        while not self.eof and len(self.pending) < size and time.monotonic() < deadline:
+            try:
+                select.select([self], [], [], deadline - time.monotonic())
+            except (OSError, ValueError):
+                break
+            self.fill(size)
+
+    def prepend(self, data):
+        self.pending = data + self.pending
+
+    def read(self, size):
+        # same as audio.Decoder.read()
+        self.fill(size)
+        if self.eof:
+            length = min(size, len(self.pending))
+        else:
+            length = min(size, len(self.pending)) // audio.FRAME_SIZE * audio.FRAME_SIZE
+        data, self.pending = self.pending[:length], self.pending[length:]
+        self.position += length
+        return data
+
+    def remaining(self):
+        return len(self.pending)
+
+    def finished(self):
+        return self.eof and not self.pending
+
+    def succeeded(self):
+        return self.stream.ended and self.stream.decoder.succeeded()
+
+    def kill(self):
+        if self.stream is None:
+            return
+        self.eof = True
+        self.pending = b''
+        if self.skipped:
+            logging.info("Shared stream {}: a reader fell behind and skipped {:.1f}s".format(
+                self.path, self.skipped / audio.BYTES_PER_SECOND))
+        self.hub.close(self)
+        self.stream = None
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+
+class StreamHub(object):
+    """The streams played by several bots at once, decoded once.
+
+    open() returns a reader of the stream of a URL, starting its decoder
+    if no bot plays it yet; the decoder is stopped when the last reader is
+    killed.
+    """
+
+    def __init__(self, buffer=20, debug=False):
+        self.capacity = int(buffer * audio.BYTES_PER_SECOND)
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.streams = {}  # url -> SharedStream
+
+    def open(self, url):
+        with self.lock:
+            stream = self.streams.get(url)
+            if stream is None or stream.ended:
+                logging.info("Starting the shared stream " + url)
+                stream = self.streams[url] = SharedStream(url, self.capacity, self.debug)
+                stream.thread.start()
+            reader = StreamReader(self, stream)
+            with stream.lock:
+                reader.cursor = stream.written
+                stream.readers.add(reader)
+            logging.debug("Shared stream {}: {} readers".format(url, len(stream.readers)))
+            return reader
+
+    def close(self, reader):
+        stream = reader.stream
+        with self.lock:
+            with stream.lock:
+                stream.readers.discard(reader)
+                last = not stream.readers
+            if last:
+                if self.streams.get(stream.url) is stream:
+                    del self.streams[stream.url]
+                logging.info("Stopping the shared stream " + stream.url)
+        if last:
+            stream.stop()
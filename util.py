@@ -1,158 +1,111 @@
 #!/usr/bin/python3
 
+import glob
 import hashlib
-import magic
+import json
 import os
+import re
+import tempfile
 import variables as var
 import zipfile
 
+ZIP_CHUNK_SIZE = 64 * 1024
 
-def get_recursive_filelist_sorted(path):
-    filelist = []
-    for root, dirs, files in os.walk(path):
-        relroot = root.replace(path, '', 1)
-        if relroot != '' and relroot in var.config.get('bot', 'ignored_folders'):
-            continue
-        if len(relroot):
-            relroot += '/'
-        for file in files:
-            if file in var.config.get('bot', 'ignored_files'):
-                continue
 
-            fullpath = os.path.join(path, relroot, file)
-            if not os.access(fullpath, os.R_OK):
-                continue
-
-            mime = magic.from_file(fullpath, mime=True)
-            if 'audio' in mime or 'audio' in magic.from_file(fullpath).lower() or 'video' in mime:
-                filelist.append(relroot + file)
-
-    filelist.sort()
-    return filelist
-
-
-# - zips all files of the given zippath (must be a directory)
-# - returns the absolute path of the created zip file
+# - zips all files of the given zippath (must be a directory), as they are
+#   (STORED, the audio files are already compressed)
+# - returns (path of the zip file, generator of its content): the generator writes the zip
+#   chunk by chunk as it is read, and saves it at the path once complete. When the zip file
+#   already exists, it is up to date and can be sent as is
 # - zip file will be in the applications tmp folder (according to configuration)
 # - format of the filename itself = prefix_hash.zip
 #       - prefix can be controlled by the caller
-#       - hash is a sha1 of the string representation of the directories' contents (which are
-#           zipped)
+#       - hash is a sha1 of the files of the directory and of their size and mtime in the
+#           library index
 def zipdir(zippath, zipname_prefix=None):
     zipname = var.config.get('bot', 'tmp_folder')
     if zipname_prefix and '../' not in zipname_prefix:
         zipname += zipname_prefix.strip().replace('/', '_') + '_'
 
-    files = get_recursive_filelist_sorted(zippath)
-    hash = hashlib.sha1((str(files).encode())).hexdigest()
+    relpath = os.path.relpath(zippath, var.music_folder)
+    if relpath == '.':
+        relpath = ''
+    files = []
+    for file in var.library.get_files(relpath):
+        entry = var.library.get_entry(file)
+        if entry and not var.library.is_ignored(file):
+            files.append((os.path.relpath(file, relpath) if relpath else file, entry['size'], entry['mtime']))
+    hash = hashlib.sha1(json.dumps(files).encode()).hexdigest()
+    prefix = zipname
     zipname += hash + '.zip'
 
-    if os.path.exists(zipname):
-        return zipname
-
-    zipf = zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED)
-
-    for file in files:
-        file_to_add = os.path.join(zippath, file)
-        if not os.access(file_to_add, os.R_OK):
-            continue
-        if file in var.config.get('bot', 'ignored_files'):
-            continue
-
-        add_file_as = os.path.relpath(os.path.join(zippath, file), os.path.join(zippath, '..'))
-        zipf.write(file_to_add, add_file_as)
-
-    zipf.close()
-    return zipname
-
-
-def write_db():
-    with open(var.dbfile, 'w') as f:
-        var.db.write(f)
-
-
-class Dir(object):
-    def __init__(self, path):
-        self.name = os.path.basename(path.strip('/'))
-        self.fullpath = path
-        self.subdirs = {}
-        self.files = []
-
-    def add_file(self, file):
-        if file.startswith(self.name + '/'):
-            file = file.replace(self.name + '/', '', 1)
-
-        if '/' in file:
-            # This file is in a subdir
-            subdir = file.split('/')[0]
-            if subdir in self.subdirs:
-                self.subdirs[subdir].add_file(file)
+    def stream():
+        sink = ZipStream()
+        fd, part = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(zipname))
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as cache, zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zipf:
+                for file, size, mtime in files:
+                    file_to_add = os.path.join(zippath, file)
+                    add_file_as = os.path.relpath(file_to_add, os.path.join(zippath, '..'))
+                    try:
+                        src = open(file_to_add, 'rb')
+                        info = zipfile.ZipInfo.from_file(file_to_add, add_file_as, strict_timestamps=False)
+                    except OSError:
+                        continue
+                    with src, zipf.open(info, 'w') as dest:
+                        while True:
+                            chunk = src.read(ZIP_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            data = sink.pop()
+                            cache.write(data)
+                            yield data
+                    data = sink.pop()
+                    cache.write(data)
+                    yield data
+                zipf.close()
+                data = sink.pop()
+                cache.write(data)
+            yield data
+            complete = True
+        finally:
+            if complete:
+                os.replace(part, zipname)
+                # older versions of the zip of this directory
+                for old in glob.glob(glob.escape(prefix) + '*.zip'):
+                    if old != zipname and re.fullmatch(re.escape(prefix) + '[0-9a-f]{40}\\.zip', old):
+                        os.remove(old)
             else:
-                self.subdirs[subdir] = Dir(os.path.join(self.fullpath, subdir))
-                self.subdirs[subdir].add_file(file)
-        else:
-            self.files.append(file)
-        return True
+                os.remove(part)
 
-    def get_subdirs(self, path=None):
-        subdirs = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                subdirs = self.subdirs[subdir].get_subdirs(searchpath)
-                subdirs = list(map(lambda subsubdir: os.path.join(subdir, subsubdir), subdirs))
-        else:
-            subdirs = self.subdirs
+    return zipname, stream()
 
-        return subdirs
 
-    def get_subdirs_recursively(self, path=None):
-        subdirs = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                subdirs = self.subdirs[subdir].get_subdirs_recursively(searchpath)
-        else:
-            subdirs = list(self.subdirs.keys())
+class ZipStream(object):
+    # unseekable file zipfile writes into, emptied by pop()
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
 
-            for key, val in self.subdirs.items():
-                subdirs.extend(map(lambda subdir: key + '/' + subdir, val.get_subdirs_recursively()))
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
 
-        subdirs.sort()
-        return subdirs
+    def tell(self):
+        return self.position
 
-    def get_files(self, path=None):
-        files = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                files = self.subdirs[subdir].get_files(searchpath)
-        else:
-            files = self.files
+    def flush(self):
+        pass
 
-        return files
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
 
-    def get_files_recursively(self, path=None):
-        files = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                files = self.subdirs[subdir].get_files_recursively(searchpath)
-        else:
-            files = self.files
 
-            for key, val in self.subdirs.items():
-                files.extend(map(lambda file: key + '/' + file, val.get_files_recursively()))
-
-        return files
-
-    def render_text(self, ident=0):
-        print('{}{}/'.format(' ' * (ident * 4), self.name))
-        for key, val in self.subdirs.items():
-            val.render_text(ident + 1)
-        for file in self.files:
-            print('{}{}'.format(' ' * (ident + 1) * 4, file))
+def write_db():
+    with open(var.dbfile, 'w') as f:
+        var.db.write(f)
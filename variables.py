@@ -1,9 +1,17 @@
-current_music = None
-playlist = []
-user = ""
+bots = {}  # name -> MumbleBot, the first one is the default bot
 music_folder = ""
 is_proxified = False
 dbfile = None
 db = None
 config = None
-next_downloaded = False
+prefetcher = None
+library = None
+search = None
+loudness = None
+cache = None
+frames = None
+radio = None
+streams = None
+metadata = None
+journal = None
+jingle = None
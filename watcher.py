@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal ctypes binding of the Linux inotify API."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        # returns a list of (wd, mask, cookie, name)
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher(threading.Thread):
+    """Keep a MusicLibrary in sync with the music folder.
+
+    inotify is used on Linux. Elsewhere, or when inotify is unavailable (no
+    more watches allowed for example), the folder is polled instead; a poll
+    only stats files, only new or modified files get analysed.
+    """
+
+    def __init__(self, library, poll_interval=60):
+        threading.Thread.__init__(self, name="LibraryWatcher")
+        self.daemon = True
+        self.library = library
+        self.poll_interval = poll_interval
+        self.inotify = None
+        self.watches = {}  # wd -> relative folder path
+        self.exit = threading.Event()
+
+    def stop(self):
+        self.exit.set()
+
+    def run(self):
+        if sys.platform.startswith('linux'):
+            try:
+                self.inotify = Inotify()
+                self._watch_tree('')
+            except (OSError, AttributeError) as e:
+                logging.warning("inotify unavailable ({}), polling the music folder every {}s".format(e, self.poll_interval))
+                if self.inotify:
+                    self.inotify.close()
+                self.inotify = None
+
+        if self.inotify:
+            logging.info("Watching {} folders of the music library".format(len(self.watches)))
+            self._run_inotify()
+        else:
+            self._run_polling()
+
+    def _run_polling(self):
+        while not self.exit.wait(self.poll_interval):
+            try:
+                self.library.scan()
+            except Exception as e:
+                # the next scan catches up
+                logging.exception(e)
+
+    def _run_inotify(self):
+        while not self.exit.is_set():
+            readable, _, _ = select.select([self.inotify.fd], [], [], 1)
+            if not readable:
+                continue
+            try:
+                self._process(self.inotify.read_events())
+            except OSError as e:
+                logging.error("Music library watcher failed: " + str(e))
+            except Exception as e:
+                # keeps watching rather than silently stopping
+                logging.exception(e)
+            self.library.flush()
+        self.inotify.close()
+
+    def _watch_tree(self, path):
+        # watches path and all its subfolders
+        for root, dirs, files in os.walk(os.path.join(self.library.path, path)):
+            relroot = os.path.relpath(root, self.library.path)
+            if relroot == '.':
+                relroot = ''
+            wd = self.inotify.add_watch(root, WATCH_MASK)
+            self.watches[wd] = relroot
+
+    def _process(self, events):
+        moved_from = {}
+        overflow = False
+
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+
+            path = os.path.join(self.watches[wd], name)
+            is_dir = mask & IN_ISDIR
+
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & IN_MOVED_TO:
+                if cookie in moved_from:
+                    old, _ = moved_from.pop(cookie)
+                    logging.debug("Library: {} renamed to {}".format(old, path))
+                    renamed = self.library.rename(old, path)
+                    if is_dir:
+                        self._rename_watches(old, path)
+                    # nothing was indexed under the old path
+                    if not renamed:
+                        if is_dir:
+                            self._add_folder(path)
+                        else:
+                            self.library.update_file(path)
+                elif is_dir:
+                    self._add_folder(path)
+                else:
+                    self.library.update_file(path)
+            elif mask & IN_CREATE:
+                if is_dir:
+                    self._add_folder(path)
+            elif mask & IN_CLOSE_WRITE:
+                logging.debug("Library: {} updated".format(path))
+                self.library.update_file(path)
+            elif mask & IN_DELETE:
+                logging.debug("Library: {} removed".format(path))
+                if is_dir:
+                    self.library.remove_folder(path)
+                else:
+                    self.library.remove_file(path)
+
+        # moved outside of the music folder
+        for path, is_dir in moved_from.values():
+            if is_dir:
+                self.library.remove_folder(path)
+                self._forget_watches(path)
+            else:
+                self.library.remove_file(path)
+
+        if overflow:
+            logging.warning("Library watcher lost events, rescanning the music folder")
+            self.library.scan()
+
+    def _add_folder(self, path):
+        try:
+            self._watch_tree(path)
+        except OSError as e:
+            logging.error("Unable to watch {}: {}".format(path, e))
+        # files may have been written before the watch was in place
+        self.library.scan(path)
+
+    def _rename_watches(self, old, new):
+        prefix = old + '/'
+        for wd, path in self.watches.items():
+            if path == old:
+                self.watches[wd] = new
+            elif path.startswith(prefix):
+                self.watches[wd] = new + '/' + path[len(prefix):]
+
+    def _forget_watches(self, path):
+        prefix = path + '/'
+        for wd, watched in list(self.watches.items()):
+            if watched == path or watched.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]